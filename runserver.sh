@@ -18,6 +18,10 @@ source venv/bin/activate
 echo "Installing requirements..."
 pip3 install -r requirements.txt
 
+# Create the table backing the shared cache
+echo "Creating cache table..."
+python3 manage.py createcachetable
+
 # Run the Gunicorn server in the background
 echo "Starting Gunicorn server..."
 nohup gunicorn world_model.wsgi &> gunicorn.log &
@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Variable, TargetYear, YearlyInputValue
+from .models import PrecomputedResult, Variable, TargetYear, YearlyInputValue
 
 class VariableAdmin(admin.ModelAdmin):
     list_display = (
@@ -31,6 +31,12 @@ class YearlyInputValueAdmin(admin.ModelAdmin):
     list_display = ('variable', 'year', 'value',)
     list_filter = ('variable', 'year',)
 
+class PrecomputedResultAdmin(admin.ModelAdmin):
+    list_display = ('variable_name', 'target_year', 'num_simulations', 'sampling', 'computed_at',)
+    list_filter = ('target_year', 'sampling',)
+    search_fields = ('variable_name',)
+
 admin.site.register(Variable, VariableAdmin)
 admin.site.register(TargetYear, TargetYearAdmin)
-admin.site.register(YearlyInputValue, YearlyInputValueAdmin)
\ No newline at end of file
+admin.site.register(YearlyInputValue, YearlyInputValueAdmin)
+admin.site.register(PrecomputedResult, PrecomputedResultAdmin)
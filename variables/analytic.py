@@ -0,0 +1,173 @@
+import numpy as np
+from scipy.stats import norm
+
+from .engine import input_series
+from .instrumentation import timed
+from .models import Variable
+from .statistics import BAND_PERCENTILES
+
+# First-order moment propagation (the delta method), a deterministic alternative to Monte Carlo.
+#
+# Every noise term of the Monte Carlo engines, one per (row with a standard deviation,
+# determining row, year), is a standard normal z. Each row is evaluated once with all the
+# noise at 0, which approximates its mean, together with its Jacobian with respect to every
+# noise term upstream of it, carried through the linearized formula year by year. A year's
+# variance is then the sum of its squared Jacobian entries, exact to first order whatever
+# the rows share upstream. The curvature of the formula and switches between its growing and
+# shrinking branches are ignored, so the bands are approximate: `manage.py benchmark` reports
+# the error against Monte Carlo.
+
+
+# A row's approximate mean series, the global ids of the noise terms it depends on (sorted)
+# and its (years x noise terms) Jacobian
+class Tangent:
+    def __init__(self, mean, columns, jacobian):
+        self.mean = mean
+        self.columns = columns
+        self.jacobian = jacobian
+
+    @property
+    def std(self):
+        return np.sqrt((self.jacobian ** 2).sum(axis=1))
+
+# Average of tangents, like mean_series for the Monte Carlo engines
+def mean_tangent(tangents):
+    if len(tangents) == 1:
+        return tangents[0]
+    columns = np.unique(np.concatenate([tangent.columns for tangent in tangents]))
+    jacobian = np.zeros((len(tangents[0].mean), len(columns)))
+    for tangent in tangents:
+        jacobian[:, np.searchsorted(columns, tangent.columns)] += tangent.jacobian
+    return Tangent(
+        np.mean([tangent.mean for tangent in tangents], axis=0),
+        columns,
+        jacobian / len(tangents),
+    )
+
+# functions.formula with every noise term at 0, and its derivatives with respect to the
+# determining series and to the row's own noise terms (global ids noise_columns, one per year,
+# all above those of the determining series)
+def linearized_formula(variable, determining, noise_columns=None):
+    current, following = determining.mean[:-1], determining.mean[1:]
+    rising = following >= current
+
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        rate = np.where(rising, (following - current) / current, (current - following) / following)
+        rate_by_current = np.where(rising, -following / current ** 2, 1 / following)
+        rate_by_following = np.where(rising, 1 / current, -current / following ** 2)
+
+        multiplication_rate = np.ones_like(rate)
+        slope = np.zeros_like(rate)
+        if variable.linear_coeff:
+            multiplication_rate += variable.linear_coeff * rate
+            slope += variable.linear_coeff
+        if variable.quadratic_coeff:
+            multiplication_rate += variable.quadratic_coeff * rate ** 2
+            slope += 2 * variable.quadratic_coeff * rate
+        if variable.cubic_coeff:
+            multiplication_rate += variable.cubic_coeff * rate ** 3
+            slope += 3 * variable.cubic_coeff * rate ** 2
+        if variable.log_coeff:
+            multiplication_rate += variable.log_coeff * np.log(rate + 1)
+            slope += variable.log_coeff / (rate + 1)
+        if variable.exp_coeff and variable.exp_rate_coeff:
+            multiplication_rate += variable.exp_coeff * (np.exp(variable.exp_rate_coeff * rate) - 1)
+            slope += variable.exp_coeff * variable.exp_rate_coeff * np.exp(variable.exp_rate_coeff * rate)
+
+    growing = rising & (multiplication_rate >= 0)
+
+    # The recurrence itself runs on plain floats, it is sequential anyway
+    mean = [variable.level_in_2023]
+    for index, (multiplier, grows) in enumerate(zip(multiplication_rate.tolist(), growing.tolist())):
+        previous = mean[index]
+        if grows:
+            mean.append(multiplier * previous)
+        elif multiplier:
+            mean.append(abs(previous / multiplier))
+        else:
+            mean.append(np.inf if previous else np.nan)
+    mean = np.array(mean)
+
+    # y[t + 1] = m[t] * y[t] (growing) or |y[t] / m[t]|, m[t] a function of rate[t]
+    previous = mean[:-1]
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        by_previous = np.where(growing, multiplication_rate, np.sign(previous) / np.abs(multiplication_rate))
+        by_rate = slope * np.where(
+            growing, previous, -np.abs(previous) * np.sign(multiplication_rate) / multiplication_rate ** 2
+        )
+
+        # What each year adds to the Jacobian, the rest is carried over from the year before
+        upstream = len(determining.columns)
+        columns = determining.columns if noise_columns is None else np.concatenate([determining.columns, noise_columns])
+        increments = np.zeros((len(rate), len(columns)))
+        increments[:, :upstream] = (
+            (by_rate * rate_by_current)[:, np.newaxis] * determining.jacobian[:-1]
+            + (by_rate * rate_by_following)[:, np.newaxis] * determining.jacobian[1:]
+        )
+        # result * (1 + sd / 100 * z), at z = 0
+        if noise_columns is not None:
+            increments[np.arange(len(rate)), upstream + np.arange(len(rate))] = variable.standard_deviation / 100 * mean[1:]
+
+        # Year t + 1 depends on the row's own noise up to year t only
+        jacobian = np.zeros((len(mean), len(columns)))
+        for index in range(len(rate)):
+            bound = min(upstream + index + 1, len(columns))
+            np.multiply(jacobian[index, :bound], by_previous[index], out=jacobian[index + 1, :bound])
+            jacobian[index + 1, :bound] += increments[index, :bound]
+
+    return Tangent(mean, columns, jacobian)
+
+# Tangents of the rows in the closure of row_ids, evaluated in topological order like
+# engine.evaluate_plan. A row's tangent is dropped once every row needing it is done.
+# Returns row id -> Tangent for row_ids, None for rows that can't be calculated.
+@timed('analytic')
+def propagate_plan(plan, row_ids, target_year):
+    order = plan.order(row_ids)
+    input_rows, inputs = input_series(plan, target_year)
+    steps = target_year - 2023
+
+    remaining = {row_id: int(row_id in row_ids) for row_id in order}
+    for row_id in order:
+        for dependency in plan.dependencies[row_id] or []:
+            remaining[dependency] += 1
+
+    # Noise terms get increasing ids in evaluation order, so upstream terms always come first
+    pair = 0
+    tangents = {}
+    for row_id in order:
+        variable = plan.variables[row_id]
+        dependencies = plan.dependencies[row_id]
+        if variable.variable_type == Variable.INPUT:
+            tangents[row_id] = Tangent(inputs[input_rows[row_id]], np.empty(0, dtype=np.int64), np.zeros((steps + 1, 0)))
+        elif dependencies is None or any(tangents[dependency] is None for dependency in dependencies):
+            tangents[row_id] = None
+        else:
+            results = []
+            for dependency in dependencies:
+                noise_columns = None
+                if variable.standard_deviation:
+                    noise_columns = np.arange(pair * steps, (pair + 1) * steps)
+                    pair += 1
+                results.append(linearized_formula(variable, tangents[dependency], noise_columns))
+            tangents[row_id] = mean_tangent(results)
+
+        for dependency in dependencies or []:
+            remaining[dependency] -= 1
+            if remaining[dependency] == 0:
+                del tangents[dependency]
+
+    return {row_id: tangents[row_id] for row_id in row_ids}
+
+# Approximate per-year mean and std of variable_name (averaged over its rows like simulate),
+# and normal P5/P50/P95 bands around them. Returns (mean, std, bands), or None.
+def analytic_moments(plan, variable_name, target_year):
+    row_ids = plan.rows_named(variable_name)
+    if not row_ids:
+        return None
+    tangents = propagate_plan(plan, row_ids, target_year)
+    if any(tangents[row_id] is None for row_id in row_ids):
+        return None
+    tangent = mean_tangent([tangents[row_id] for row_id in row_ids])
+    std = tangent.std
+    bands = {percentile: tangent.mean + norm.ppf(percentile / 100) * std for percentile in BAND_PERCENTILES}
+    return tangent.mean, std, bands
@@ -0,0 +1,147 @@
+import fnmatch
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, wait
+from pathlib import Path
+
+import numpy as np
+
+from .engine import simulate_statistics_many
+from .models import Variable
+from .parallel import get_process_pool
+
+# Headless batch forecasts, run by `python manage.py batch_run`: variables x target years x
+# seeds, each task simulated on the process pool and written out as soon as it is done, in
+# long format (one row per variable, target year, seed and year).
+
+COLUMNS = ('variable', 'target_year', 'seed', 'year', 'mean', 'std', 'p5', 'p50', 'p95')
+OUTPUT_FORMATS = ('parquet', 'arrow', 'npz')
+OUTPUT_EXTENSIONS = {'.parquet': 'parquet', '.arrow': 'arrow', '.feather': 'arrow', '.npz': 'npz'}
+
+
+# Every chunk is stored as its own set of arrays in the archive ('mean_00000.npy', ...),
+# so nothing is held in memory between chunks. np.load(path) reads them back.
+class NpzWriter:
+    def __init__(self, path):
+        self.archive = zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED, allowZip64=True)
+        self.chunks = 0
+
+    def write(self, columns):
+        for name, values in columns.items():
+            with self.archive.open(f'{name}_{self.chunks:05d}.npy', 'w', force_zip64=True) as file:
+                np.lib.format.write_array(file, np.asarray(values), allow_pickle=False)
+        self.chunks += 1
+
+    def close(self):
+        self.archive.close()
+
+
+# A row group (Parquet) or record batch (Arrow IPC file) per chunk. pyarrow is optional.
+class ArrowWriter:
+    def __init__(self, path, output_format):
+        try:
+            import pyarrow
+            import pyarrow.ipc
+            import pyarrow.parquet
+        except ImportError:
+            raise ValueError(f'{output_format} output needs pyarrow (pip install pyarrow), or write .npz instead')
+        self.pyarrow = pyarrow
+        self.schema = pyarrow.schema(
+            [('variable', pyarrow.string()), ('target_year', pyarrow.int32()), ('seed', pyarrow.int64()), ('year', pyarrow.int32())]
+            + [(column, pyarrow.float64()) for column in COLUMNS[4:]]
+        )
+        if output_format == 'parquet':
+            self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+        else:
+            self.writer = pyarrow.ipc.new_file(path, self.schema)
+
+    def write(self, columns):
+        self.writer.write_table(self.pyarrow.Table.from_pydict(columns, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+# The format is taken from the file extension unless given. Raises ValueError.
+def open_writer(path, output_format=None):
+    output_format = output_format or OUTPUT_EXTENSIONS.get(Path(path).suffix.lower())
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f'Unknown output format for {path}, use one of {", ".join(OUTPUT_FORMATS)}')
+    if output_format == 'npz':
+        return NpzWriter(path)
+    return ArrowWriter(path, output_format)
+
+# Variable name -> one of its row ids, for the calculated variables matching any of the
+# patterns (names or shell-style globs, e.g. 'Energy*'), in the order of the plan
+def match_variables(plan, patterns):
+    variables = {}
+    for row_id in sorted(plan.variables):
+        variable = plan.variables[row_id]
+        if variable.variable_type == Variable.CALCULATED and any(fnmatch.fnmatchcase(variable.variable_name, pattern) for pattern in patterns):
+            variables.setdefault(variable.variable_name, row_id)
+    return variables
+
+# Runs in a worker process: one (target year, seed) of a batch of variables, simulated in
+# one shared pass. Returns (target_year, seed, variable name -> SimulationStatistics or None).
+def simulate_task(plan, variable_names, target_year, seed, num_simulations, sampling, chunk_size):
+    statistics = simulate_statistics_many(
+        plan, variable_names, target_year, num_simulations, np.random.default_rng(seed), sampling, chunk_size
+    )
+    return target_year, seed, statistics
+
+# One task's results as columns, None for the variables that can't be calculated left out
+def task_columns(target_year, seed, statistics):
+    years = np.arange(2023, target_year + 1)
+    calculated = [(variable_name, accumulator) for variable_name, accumulator in statistics.items() if accumulator is not None]
+    if not calculated:
+        return None
+    bands = [accumulator.bands() for _, accumulator in calculated]
+    return {
+        'variable': np.repeat([variable_name for variable_name, _ in calculated], len(years)),
+        'target_year': np.full(len(calculated) * len(years), target_year, dtype=np.int32),
+        'seed': np.full(len(calculated) * len(years), seed, dtype=np.int64),
+        'year': np.tile(years, len(calculated)).astype(np.int32),
+        'mean': np.concatenate([accumulator.mean for _, accumulator in calculated]),
+        'std': np.concatenate([accumulator.std for _, accumulator in calculated]),
+        **{
+            f'p{percentile}': np.concatenate([variable_bands[percentile] for variable_bands in bands])
+            for percentile in bands[0]
+        },
+    }
+
+# Simulates the variables (name -> row id, see match_variables) at every target year and
+# seed, batch_size variables per task, and hands every finished task to writer.write. With
+# processes > 1 the tasks run on the process pool, at most 2 per process at a time, so memory
+# stays bounded whatever the number of tasks. Returns (variable-years written, failed variable runs).
+def run_batch(plan, variables, target_years, seeds, writer, num_simulations=100, sampling='random', processes=1, batch_size=50, chunk_size=1024):
+    names = [variable_name for variable_name in variables if plan.calculable(variable_name)]
+    tasks = [
+        (names[start:start + batch_size], target_year, seed)
+        for target_year in target_years for seed in seeds for start in range(0, len(names), batch_size)
+    ]
+
+    variable_years = 0
+    failed = (len(variables) - len(names)) * len(target_years) * len(seeds)
+
+    def write(target_year, seed, statistics):
+        nonlocal variable_years, failed
+        failed += sum(accumulator is None for accumulator in statistics.values())
+        columns = task_columns(target_year, seed, statistics)
+        if columns is not None:
+            writer.write(columns)
+            variable_years += len(columns['year'])
+
+    if processes <= 1:
+        for batch, target_year, seed in tasks:
+            write(*simulate_task(plan, batch, target_year, seed, num_simulations, sampling, chunk_size))
+        return variable_years, failed
+
+    pool = get_process_pool(processes)
+    pending = set()
+    for batch, target_year, seed in tasks:
+        if len(pending) >= 2 * processes:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                write(*future.result())
+        pending.add(pool.submit(simulate_task, plan, batch, target_year, seed, num_simulations, sampling, chunk_size))
+    for future in wait(pending).done:
+        write(*future.result())
+    return variable_years, failed
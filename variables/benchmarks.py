@@ -0,0 +1,179 @@
+import random
+import time
+import tracemalloc
+
+import numpy as np
+from django.core.cache import cache, caches
+from django.test import RequestFactory
+
+from . import views
+from .caching import result_cache, series_cache
+from .functions import calc_yearly_values, display_graph, graph_series, run_simulations
+from .instrumentation import measure
+from .models import Variable, TargetYear, YearlyInputValue
+
+# Synthetic models and timings for the simulation engine and the heavy views,
+# run by `python manage.py benchmark` against a throwaway test database.
+
+SCENARIOS = ('fan_in', 'deep_chain', 'wide_inputs', 'siblings')
+
+
+def random_coefficients(rng):
+    coefficients = {
+        'linear_coeff': rng.uniform(0.3, 1.1),
+        'quadratic_coeff': rng.choice([None, rng.uniform(0, 0.2)]),
+        'log_coeff': rng.choice([None, rng.uniform(0, 0.2)]),
+        'standard_deviation': rng.choice([None, rng.uniform(0.5, 3)]),
+    }
+    if rng.random() < 0.2:
+        coefficients['exp_coeff'] = rng.uniform(0, 0.1)
+        coefficients['exp_rate_coeff'] = rng.uniform(0.5, 1)
+    return coefficients
+
+def create_inputs(count, target_year, rng):
+    inputs = Variable.objects.bulk_create([
+        Variable(variable_name=f'Input {index}', variable_type=Variable.INPUT, level_in_2023=rng.uniform(50, 150))
+        for index in range(count)
+    ])
+    # Sparse yearly points: one every 10 to 25 years
+    points = []
+    for variable in inputs:
+        year = 2023
+        level = variable.level_in_2023
+        while True:
+            year += rng.randint(10, 25)
+            if year > target_year:
+                break
+            level *= rng.uniform(0.9, 1.15)
+            points.append(YearlyInputValue(variable=variable, year=year, value=level))
+    YearlyInputValue.objects.bulk_create(points)
+    return inputs
+
+def create_calculated(name, determining_value, rng):
+    return Variable.objects.create(
+        variable_name=name, variable_type=Variable.CALCULATED, level_in_2023=rng.uniform(10, 100),
+        determining_value=determining_value, **random_coefficients(rng),
+    )
+
+# Builds one synthetic model and returns the ids of the two variables to plot
+def build_model(scenario, size, target_year, seed=0):
+    rng = random.Random(seed)
+    Variable.objects.all().delete()
+    TargetYear.objects.all().delete()
+    TargetYear.objects.create(year=target_year)
+
+    if scenario == 'fan_in':
+        # One variable determined by `size` inputs, and one downstream of it
+        inputs = create_inputs(size, target_year, rng)
+        fan_in = [create_calculated('Fan-in', variable, rng) for variable in inputs]
+        downstream = create_calculated('Fan-in downstream', fan_in[0], rng)
+        return downstream.id, fan_in[0].id
+
+    if scenario == 'deep_chain':
+        # A chain of `size` calculated variables on top of one input
+        previous = create_inputs(1, target_year, rng)[0]
+        chain = []
+        for depth in range(size):
+            previous = create_calculated(f'Chain {depth}', previous, rng)
+            chain.append(previous)
+        return chain[-1].id, chain[len(chain) // 2].id
+
+    if scenario == 'wide_inputs':
+        # `size` inputs, each driving its own calculated variable
+        inputs = create_inputs(size, target_year, rng)
+        calculated = [create_calculated(f'Calculated {index}', variable, rng) for index, variable in enumerate(inputs)]
+        return calculated[0].id, calculated[-1].id
+
+    if scenario == 'siblings':
+        # `size` rows of one calculated variable driven by the same input (averaged like
+        # calc_yearly_values does), and one variable downstream of them
+        variable = create_inputs(1, target_year, rng)[0]
+        siblings = [create_calculated('Sibling', variable, rng) for _ in range(size)]
+        downstream = create_calculated('Siblings downstream', siblings[0], rng)
+        return downstream.id, siblings[-1].id
+
+    raise ValueError(f'Unknown benchmark scenario: {scenario}')
+
+def reset_caches():
+    cache.clear()
+    caches['results'].clear()
+    result_cache.local.clear()
+    series_cache.clear()
+
+# Wall time and query count of `repeat` cold runs (caches cleared before each),
+# then the peak traced memory of one more run
+def benchmark(name, function, repeat):
+    timings = []
+    queries = []
+    for _ in range(repeat):
+        reset_caches()
+        with measure() as measured:
+            function()
+        timings.append(measured.total)
+        queries.append(measured.queries)
+
+    reset_caches()
+    tracemalloc.start()
+    try:
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'name': name,
+        'wall_s': float(np.median(timings)),
+        'wall_min_s': float(np.min(timings)),
+        'peak_memory_mb': peak / 2 ** 20,
+        'queries': int(np.median(queries)),
+    }
+
+# Largest error over the years of the analytic engine against Monte Carlo with
+# num_simulations: for the mean in units of the Monte Carlo std, and for the std relative
+# to it. Monte Carlo's own noise accounts for about 1 / sqrt(num_simulations) of both.
+def analytic_accuracy(variable_id, target_year, num_simulations):
+    reset_caches()
+    analytic_mean, analytic_std, *_ = run_simulations(variable_id, target_year, engine='analytic')
+    mean_values, std_dev_values, *_ = run_simulations(variable_id, target_year, num_simulations, seed=0)
+    # Rounding leaves a tiny std even where nothing is random
+    stochastic = std_dev_values > 1e-9 * np.abs(mean_values)
+    return {
+        'analytic_mean_error': float(np.max(
+            np.abs(analytic_mean - mean_values)[stochastic] / std_dev_values[stochastic], initial=0
+        )),
+        'analytic_std_error': float(np.max(
+            np.abs(analytic_std - std_dev_values)[stochastic] / std_dev_values[stochastic], initial=0
+        )),
+        'analytic_reference_simulations': num_simulations,
+    }
+
+def run_benchmarks(scenarios=SCENARIOS, size=100, target_year=2150, num_simulations=100, repeat=3, include_loop=False, accuracy_simulations=10000):
+    factory = RequestFactory()
+    results = []
+    for scenario in scenarios:
+        started = time.perf_counter()
+        first_id, second_id = build_model(scenario, size, target_year)
+        build_time = time.perf_counter() - started
+        first_variable = Variable.objects.get(id=first_id)
+
+        cases = [
+            ('calc_yearly_values', lambda: calc_yearly_values(first_variable, target_year)),
+            ('run_simulations', lambda: run_simulations(first_id, target_year, num_simulations)),
+            ('run_simulations[analytic]', lambda: run_simulations(first_id, target_year, engine='analytic')),
+            ('display_graph', lambda: display_graph(first_id, second_id)),
+            ('graph_series', lambda: graph_series([first_id, second_id])),
+            ('views.input_yearly_values', lambda: views.input_yearly_values(factory.get('/input_yearly_values/'))),
+            ('views.graph', lambda: views.graph(factory.get('/output/graph', {
+                'first_selected_variable': first_id, 'second_selected_variable': second_id,
+            }))),
+        ]
+        if include_loop:
+            cases.append(('run_simulations[loop]', lambda: run_simulations(first_id, target_year, num_simulations, engine='loop')))
+
+        for name, function in cases:
+            result = benchmark(name, function, repeat)
+            result.update({'scenario': scenario, 'size': size, 'target_year': target_year, 'build_s': build_time})
+            if name == 'run_simulations[analytic]' and accuracy_simulations:
+                result.update(analytic_accuracy(first_id, target_year, accuracy_simulations))
+            results.append(result)
+    return results
@@ -0,0 +1,115 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from uuid import uuid4
+
+from django.core.cache import cache, caches
+
+# Define cache timeout (seconds)
+CACHE_TIMEOUT = 60 * 15
+
+# Simulation results stay cached for a day after their last use
+RESULT_CACHE_TIMEOUT = 60 * 60 * 24
+RESULT_CACHE_LOCAL_ENTRIES = 256
+
+# Deterministic row series kept per process, keyed by row fingerprint (see plan.fingerprints)
+SERIES_CACHE_ENTRIES = 4096
+
+# Part of every result key, bumped whenever the shape of the cached results changes
+RESULT_FORMAT = 2
+
+REVISION_KEY = 'world_model:revision'
+
+# Every cached model read is keyed by the current model revision. Saving or deleting
+# a Variable, YearlyInputValue or TargetYear replaces the revision (see signals.py),
+# so all workers sharing the cache stop reading the old entries at once and the old
+# entries simply expire.
+def model_revision():
+    revision = cache.get(REVISION_KEY)
+    if revision is None:
+        cache.add(REVISION_KEY, uuid4().hex, None)
+        revision = cache.get(REVISION_KEY)
+    return revision
+
+# A fresh random token rather than an increment, so concurrent bumps can't be lost
+def bump_model_revision():
+    cache.set(REVISION_KEY, uuid4().hex, None)
+
+def cached(key, loader, timeout=CACHE_TIMEOUT):
+    versioned_key = f'world_model:{model_revision()}:{key}'
+    value = cache.get(versioned_key)
+    if value is None:
+        value = loader()
+        cache.set(versioned_key, value, timeout)
+    return value
+
+
+# Bounded in-process LRU with a TTL, thread safe
+class LRUCache:
+    def __init__(self, max_entries, timeout):
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.timeout, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+# Simulation results live in a per-process LRU in front of the shared 'results' cache.
+# Every hit on the shared cache pushes the entry's expiry back, so results nobody
+# looks at expire first while popular ones stay warm for every worker.
+class ResultCache:
+    def __init__(self, alias='results', max_local_entries=RESULT_CACHE_LOCAL_ENTRIES, timeout=RESULT_CACHE_TIMEOUT):
+        self.alias = alias
+        self.timeout = timeout
+        self.local = LRUCache(max_local_entries, timeout)
+
+    @staticmethod
+    def key(*parts):
+        return f'simulation:{RESULT_FORMAT}:' + hashlib.sha256(repr(parts).encode()).hexdigest()
+
+    def get(self, key):
+        value = self.local.get(key)
+        if value is None:
+            shared = caches[self.alias]
+            value = shared.get(key)
+            if value is not None:
+                shared.touch(key, self.timeout)
+                self.local.set(key, value)
+        return value
+
+    # shared=False keeps the result in this process only (e.g. what-if scenarios)
+    def set(self, key, value, shared=True):
+        self.local.set(key, value)
+        if shared:
+            caches[self.alias].set(key, value, self.timeout)
+
+
+result_cache = ResultCache()
+
+# Series of rows without noise upstream, (row fingerprint, target year) -> read-only
+# (1 x years) array. An edit changes the fingerprints of the edited row and of the rows
+# downstream of it only, so every other series stays valid and is reused across plans.
+series_cache = LRUCache(SERIES_CACHE_ENTRIES, RESULT_CACHE_TIMEOUT)
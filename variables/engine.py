@@ -0,0 +1,268 @@
+from collections import defaultdict
+
+import numpy as np
+from scipy.interpolate import PchipInterpolator
+
+from .caching import series_cache
+from .instrumentation import timed
+from .models import Variable
+from .sampling import NoiseSampler
+from .statistics import SimulationStatistics
+
+# Batched Monte Carlo engine: every series is a (simulations x years) array,
+# so one pass through the dependency chain evaluates all simulations at once.
+# Rows without noise anywhere upstream are the same in every simulation; they are
+# computed once as a (1 x years) array and broadcast against the stochastic ones.
+
+
+# Vectorized version of functions.formula for a group of sibling rows driven by the same
+# determining series: the rate is computed once and each coefficient term once, then added
+# to the rows that set it. coefficients are the group's packed arrays (plan.packed_coefficients),
+# standard_normals the (rows x simulations x years - 1) noise of a group with standard deviations.
+# Returns a (rows x simulations x years) array, with as many simulations as determining_values
+# has rows (1 when they are deterministic) when the group has no noise.
+@timed('formula')
+def formula_kernel(coefficients, determining_values, standard_normals=None):
+    group_size = len(coefficients['level_in_2023'])
+
+    # Year-major internally (years x rows x simulations), so every step of the yearly
+    # recurrence below reads and writes contiguous memory
+    determining_values = np.ascontiguousarray(np.asarray(determining_values, dtype=float).T)
+    current, following = determining_values[:-1, np.newaxis, :], determining_values[1:, np.newaxis, :]
+    rising = following >= current
+
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        rate = np.where(rising, (following - current) / current, (current - following) / following)
+
+        terms = (
+            ('linear_coeff', lambda exp_rate: rate),
+            ('quadratic_coeff', lambda exp_rate: rate ** 2),
+            ('cubic_coeff', lambda exp_rate: rate ** 3),
+            ('log_coeff', lambda exp_rate: np.log(rate + 1)),
+            ('exp_coeff', lambda exp_rate: np.exp(exp_rate[:, np.newaxis] * rate) - 1),
+        )
+        multiplication_rate = np.ones((rate.shape[0], group_size, rate.shape[2]))
+        for field, term in terms:
+            # Terms are skipped for the rows that don't set them, as in formula
+            active = np.flatnonzero(coefficients[field])
+            if len(active) == group_size:
+                multiplication_rate += coefficients[field][:, np.newaxis] * term(coefficients['exp_rate_coeff'])
+            elif len(active):
+                multiplication_rate[:, active] += coefficients[field][active, np.newaxis] * term(coefficients['exp_rate_coeff'][active])
+
+    shrinking = ~(rising & (multiplication_rate >= 0))
+
+    # N(result, result * sd) is the same distribution as result * (1 + sd * z), z standard normal
+    noise = None
+    simulations = rate.shape[2]
+    if standard_normals is not None:
+        simulations = standard_normals.shape[1]
+        standard_normals = np.ascontiguousarray(standard_normals.transpose(2, 0, 1))
+        noise = 1 + coefficients['standard_deviation'][:, np.newaxis] / 100 * standard_normals
+
+    # Each year is written straight into results, with one scratch buffer for the
+    # shrinking branch, so the loop doesn't allocate
+    results = np.empty((rate.shape[0] + 1, group_size, simulations))
+    results[0] = coefficients['level_in_2023'][:, np.newaxis]
+    shrinking_values = np.empty((group_size, simulations))
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        for index in range(rate.shape[0]):
+            previous, result = results[index], results[index + 1]
+            np.multiply(multiplication_rate[index], previous, out=result)
+            np.divide(previous, multiplication_rate[index], out=shrinking_values)
+            np.abs(shrinking_values, out=shrinking_values)
+            np.copyto(result, shrinking_values, where=shrinking[index])
+            if noise is not None:
+                result *= noise[index]
+
+    return np.ascontiguousarray(results.transpose(1, 2, 0))
+
+# Every Input row of the plan interpolated onto the 2023..target_year grid in one batch.
+# Inputs whose fingerprint is unchanged are copied from the series cache, the dirty ones
+# are interpolated together: inputs whose points fall on the same years share one
+# PchipInterpolator over all their values, and an input with no points besides 2023
+# stays flat. The result is kept on the plan, so it lives as long as the cached plan.
+# Returns (row id -> matrix row, read-only (inputs x years) matrix).
+@timed('interpolation')
+def input_series(plan, target_year):
+    if target_year in plan.interpolated_inputs:
+        return plan.interpolated_inputs[target_year]
+
+    fingerprints, _ = plan.fingerprints()
+    row_ids = sorted(row_id for row_id, variable in plan.variables.items() if variable.variable_type == Variable.INPUT)
+    rows = {row_id: index for index, row_id in enumerate(row_ids)}
+    years = np.arange(2023, target_year + 1)
+    matrix = np.empty((len(row_ids), len(years)))
+
+    groups = defaultdict(list)
+    for row_id in row_ids:
+        series = series_cache.get((fingerprints[row_id], target_year))
+        if series is not None:
+            matrix[rows[row_id]] = series[0]
+            continue
+        points = [(2023, plan.variables[row_id].level_in_2023)]
+        points += [(year, value) for year, value in plan.input_points.get(row_id, []) if value]
+        groups[tuple(year for year, _ in points)].append((row_id, [value for _, value in points]))
+
+    for knots, members in groups.items():
+        indexes = [rows[row_id] for row_id, _ in members]
+        values = np.array([values for _, values in members], dtype=float)
+        if len(knots) == 1:
+            matrix[indexes] = values
+        else:
+            matrix[indexes] = PchipInterpolator(np.array(knots), values, axis=1)(years)
+        for row_id, _ in members:
+            series = matrix[rows[row_id], np.newaxis].copy()
+            series.setflags(write=False)
+            series_cache.set((fingerprints[row_id], target_year), series)
+    matrix.setflags(write=False)
+
+    plan.interpolated_inputs[target_year] = rows, matrix
+    return rows, matrix
+
+# Mean of series that may have 1 or num_simulations rows
+def mean_series(series):
+    return np.mean(np.broadcast_arrays(*series), axis=0)
+
+# Evaluates the closure of row_ids in topological order, every row exactly once.
+# Returns row id -> (num_simulations x years) array, (1 x years) for deterministic rows,
+# or None for rows that can't be calculated. The noise is drawn up to noise_target_year
+# when it is later than target_year, see sampling.NoiseSampler.
+@timed('calc_yearly_values')
+def evaluate_plan(plan, row_ids, target_year, num_simulations, rng, sampling='random', noise_target_year=None):
+    # Deterministic rows whose fingerprint is unchanged since they were last calculated
+    # are taken from the series cache, and the rows upstream of them aren't evaluated.
+    # Only the rows an edit made dirty (and the stochastic ones) are recomputed.
+    fingerprints, stochastic = plan.fingerprints()
+    known = {}
+    for row_id in plan.closure(row_ids):
+        if fingerprints[row_id] is not None and not stochastic[row_id]:
+            series = series_cache.get((fingerprints[row_id], target_year))
+            if series is not None:
+                known[row_id] = series
+
+    order = plan.order(row_ids, boundary=known)
+    input_rows, inputs = input_series(plan, target_year)
+
+    # One noise term per (variable with a standard deviation, determining row) pair
+    sampler = NoiseSampler(sampling, rng, num_simulations, (noise_target_year or target_year) - 2023)
+    steps = target_year - 2023
+
+    values = dict(known)
+    in_closure = set(order)
+    for row_id in order:
+        if row_id in values:
+            continue
+        variable = plan.variables[row_id]
+        dependencies = plan.dependencies[row_id]
+        if variable.variable_type == Variable.INPUT:
+            values[row_id] = inputs[input_rows[row_id], np.newaxis]
+        elif dependencies is None or any(values[dependency] is None for dependency in dependencies):
+            values[row_id] = None
+        else:
+            # The row's siblings have the same dependencies, so they are all ready now too
+            group = [sibling for sibling in plan.siblings[row_id] if sibling in in_closure and sibling not in values]
+            coefficients = plan.packed_coefficients(group)
+            results = [
+                formula_kernel(
+                    coefficients, values[dependency],
+                    np.stack([sampler.normal((sibling, dependency), steps) for sibling in group])
+                    if variable.standard_deviation else None,
+                )
+                for dependency in dependencies
+            ]
+            for index, sibling in enumerate(group):
+                values[sibling] = mean_series([result[index] for result in results])
+                if not stochastic[sibling]:
+                    values[sibling].setflags(write=False)
+                    series_cache.set((fingerprints[sibling], target_year), values[sibling])
+
+    return values
+
+# Simulates every row named variable_name and averages them per simulation,
+# like the loop in functions.run_simulations. Returns a (num_simulations x years) array,
+# a read-only broadcast of one series when nothing upstream has noise.
+def simulate(plan, variable_name, target_year, num_simulations, rng, sampling='random', noise_target_year=None):
+    row_ids = plan.rows_named(variable_name)
+    if not row_ids:
+        return None
+
+    values = evaluate_plan(plan, row_ids, target_year, num_simulations, rng, sampling, noise_target_year)
+    if any(values[row_id] is None for row_id in row_ids):
+        return None
+    simulated_values = mean_series([values[row_id] for row_id in row_ids])
+    return np.broadcast_to(simulated_values, (num_simulations, simulated_values.shape[1]))
+
+# Simulates num_simulations in chunks of chunk_size and streams them into a
+# SimulationStatistics (moments and quantile sketch), so memory is bounded by the chunk
+# size rather than the number of simulations. Returns None when the variable can't be calculated.
+def simulate_statistics(plan, variable_name, target_year, num_simulations, rng, sampling='random', chunk_size=1024):
+    return simulate_statistics_many(plan, [variable_name], target_year, num_simulations, rng, sampling, chunk_size)[variable_name]
+
+# simulate_statistics for several variables at once: every chunk evaluates the union of
+# their closures in one pass, so the rows they share are simulated once and every variable
+# is calculated from the same draws. Each noise term has its own stream whatever the sampling
+# (see sampling.NoiseSampler), so a variable's statistics are the same as when it is simulated
+# alone. Returns variable name -> SimulationStatistics, or None for the variables that can't
+# be calculated. Raises DependencyCycleError if any of them is in or after a cycle.
+def simulate_statistics_many(plan, variable_names, target_year, num_simulations, rng, sampling='random', chunk_size=1024):
+    rows = {variable_name: plan.rows_named(variable_name) for variable_name in variable_names}
+    statistics = {variable_name: SimulationStatistics() if row_ids else None for variable_name, row_ids in rows.items()}
+    row_ids = sorted({row_id for variable_name in rows if statistics[variable_name] for row_id in rows[variable_name]})
+    if not row_ids:
+        return statistics
+
+    simulated = 0
+    while simulated < num_simulations:
+        chunk = min(chunk_size, num_simulations - simulated)
+        values = evaluate_plan(plan, row_ids, target_year, chunk, rng, sampling)
+        for variable_name, accumulator in statistics.items():
+            if accumulator is None:
+                continue
+            if any(values[row_id] is None for row_id in rows[variable_name]):
+                statistics[variable_name] = None
+                continue
+            simulated_values = mean_series([values[row_id] for row_id in rows[variable_name]])
+            accumulator.add(np.broadcast_to(simulated_values, (chunk, simulated_values.shape[1])))
+        simulated += chunk
+    return statistics
+
+# Paired Monte Carlo: simulates variable_name under two plans (e.g. baseline and scenario)
+# and/or two target years from the same seed, so both runs draw the same noise for every
+# variable and year (common random numbers, see sampling.NoiseSampler), and accumulates
+# the per-simulation differences second - first over their common years. The difference
+# has far less variance than that of two independent runs. Both draw their noise up to the
+# later target year, so that Latin hypercube and Sobol' runs share it too.
+# Returns (first, second, difference) SimulationStatistics, or None.
+def paired_statistics(plan, other_plan, variable_name, target_year, other_target_year, num_simulations, seed, sampling='random', chunk_size=1024):
+    rng, other_rng = np.random.default_rng(seed), np.random.default_rng(seed)
+    noise_target_year = max(target_year, other_target_year)
+    first, second, difference = SimulationStatistics(), SimulationStatistics(), SimulationStatistics()
+    while first.count < num_simulations:
+        chunk = min(chunk_size, num_simulations - first.count)
+        first_values = simulate(plan, variable_name, target_year, chunk, rng, sampling, noise_target_year)
+        second_values = simulate(other_plan, variable_name, other_target_year, chunk, other_rng, sampling, noise_target_year)
+        if first_values is None or second_values is None:
+            return None
+        years = min(first_values.shape[1], second_values.shape[1])
+        first.add(first_values)
+        second.add(second_values)
+        difference.add(second_values[:, :years] - first_values[:, :years])
+    return first, second, difference
+
+# Adaptive Monte Carlo: simulates batches until the standard errors of every year's mean
+# and std are within `tolerance` (relative to the mean) or max_simulations have run.
+# Returns the SimulationStatistics, whose count is the number of simulations used.
+def adaptive_statistics(plan, variable_name, target_year, rng, tolerance, batch_size=100, max_simulations=10000, sampling='random'):
+    accumulator = SimulationStatistics()
+    if not plan.is_stochastic(plan.rows_named(variable_name)):
+        max_simulations = batch_size = 1
+
+    while accumulator.count < max_simulations:
+        simulated_values = simulate(plan, variable_name, target_year, min(batch_size, max_simulations - accumulator.count), rng, sampling)
+        if simulated_values is None:
+            return None
+        accumulator.add(simulated_values)
+        if accumulator.converged(tolerance):
+            break
+    return accumulator
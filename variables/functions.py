@@ -4,32 +4,43 @@ import plotly.io as pio
 import numpy as np
 import logging
 import math
-from scipy.interpolate import PchipInterpolator
-from functools import lru_cache
+import os
 
-from django.core.cache import cache # Import Django's caching system if necessary
+from django.conf import settings
 
-from .models import Variable, TargetYear, YearlyInputValue
+from .models import PrecomputedResult, Variable, TargetYear
+from .analytic import analytic_moments
+from .caching import cached, result_cache
+from .engine import adaptive_statistics, input_series, paired_statistics, simulate_statistics_many
+from .instrumentation import timed
+from .parallel import parallel_statistics
+from .plan import PLAN_FORMAT, DependencyCycleError, compile_plan
+from .statistics import BAND_PERCENTILES, SimulationStatistics
 
 logger = logging.getLogger(__name__)
 
-# Define cache timeout (seconds)
-CACHE_TIMEOUT = 60 * 15
-
-# Cache results for frequent queries
-@lru_cache(maxsize=128)
+# Cache results for frequent queries, shared by every worker and invalidated on model changes
 def get_variable_by_id(variable_id):
-    return Variable.objects.get(id=variable_id)
-
-@lru_cache(maxsize=128)
-def get_yearly_input_values(variable_id):
-    return list(YearlyInputValue.objects.filter(variable=variable_id))
+    return cached(f'variable:{variable_id}', lambda: Variable.objects.select_related('determining_value').get(id=variable_id))
 
-@lru_cache(maxsize=1) # Assuming target year is rarely changed
 def get_target_year():
-    return TargetYear.objects.get().year
+    return cached('target_year', lambda: TargetYear.objects.get().year)
+
+def get_evaluation_plan():
+    return cached(f'evaluation_plan:{PLAN_FORMAT}', load_evaluation_plan)
+
+# The plan, with the inputs already interpolated for the target year so that every
+# worker reading the cached plan reuses them
+def load_evaluation_plan():
+    plan = compile_plan()
+    try:
+        input_series(plan, TargetYear.objects.get().year)
+    except TargetYear.DoesNotExist:
+        pass
+    return plan
 
 # Calculate the value from variable and input value
+@timed('formula')
 def formula(variable, determining_values):
     results = [variable.level_in_2023]
     
@@ -40,8 +51,6 @@ def formula(variable, determining_values):
         else:
             rate = ((determining_values[index] - (determining_values[index + 1])) / determining_values[index + 1])
         
-        print('rate-->', rate)
-
         if variable.linear_coeff:
             multiplication_rate += variable.linear_coeff * rate
 
@@ -68,27 +77,14 @@ def formula(variable, determining_values):
 
         results.append(result)
 
-    print('results--->', results)
     return results
 
+@timed('calc_yearly_values')
 def calc_yearly_values(variable, target_year):
-    if variable.variable_type == 'Input':   
-        try:
-            year = [2023]
-            value = [variable.level_in_2023]
-            variable_values = get_yearly_input_values(variable.id)
-
-            for item in variable_values:
-                if item.value:
-                    year.append(item.year)
-                    value.append(item.value)
-            spl = PchipInterpolator(np.array(year), np.array(value))
-            year_new = np.linspace(2023, target_year, num=target_year-2022)
-            input_values = spl(year_new)
-            return input_values
-        except YearlyInputValue.DoesNotExist:
-            logger.error(f'Value for {variable.variable_name} in year {target_year} not found')
-            return None
+    if variable.variable_type == 'Input':
+        # Every input is interpolated in one batch, kept with the cached plan
+        rows, inputs = input_series(get_evaluation_plan(), target_year)
+        return inputs[rows[variable.id]]
     else:
         values = []
         determining_variables = Variable.objects.filter(variable_name=variable.determining_value.variable_name)
@@ -100,10 +96,309 @@ def calc_yearly_values(variable, target_year):
 
         return np.mean(np.array(values), axis=0).tolist()
 
-def run_simulations(selected_variable_id, target_year, num_simulations=100):
+def simulation_title(variables):
+    title = []
+    for variable in variables:
+        if len(title) == 0:
+            if variable.determining_value:
+                title.append(f'(<b>{variable.variable_name}</b> according to the <b>{variable.determining_value.variable_name}</b>)')
+            else:
+                title.append(f'(<b>{variable.variable_name}</b>)')
+        else:
+            title[-1] = title[-1][:-1]
+            title.append(f'& <b>{variable.determining_value.variable_name}</b>)')
+    return title
+
+# engine='vectorized' evaluates every simulation at once as a (simulations x years) array,
+# engine='loop' is the original one-simulation-at-a-time implementation,
+# engine='analytic' approximates the mean and std without simulating (see analytic.py).
+# processes > 1 splits the simulations across a process pool (default: SIMULATION_PROCESSES).
+# sampling is one of sampling.SAMPLING_METHODS (vectorized engine only, default: SIMULATION_SAMPLING).
+# Returns (mean, std, title, bands), bands being {percentile: values} for statistics.BAND_PERCENTILES.
+@timed('run_simulations')
+def run_simulations(selected_variable_id, target_year, num_simulations=100, engine='vectorized', seed=None, processes=None, sampling=None):
+    if engine == 'loop':
+        return run_simulations_loop(selected_variable_id, target_year, num_simulations)
+    if engine == 'analytic':
+        return run_analytic_simulations(selected_variable_id, target_year)
+    if engine != 'vectorized':
+        raise ValueError(f'Unknown simulation engine: {engine}')
+
+    return run_simulations_many([selected_variable_id], target_year, num_simulations, seed, processes, sampling)[0]
+
+# run_simulations for several variables at once, returns one result (or None) per variable.
+# `plan` is the database's unless given, e.g. already loaded or with what-if overrides
+# (whose results shared=False keeps out of the shared cache).
+# With processes > 1 the uncached variables are simulated side by side on the process pool.
+@timed('run_simulations')
+def run_simulations_many(selected_variable_ids, target_year, num_simulations=100, seed=None, processes=None, sampling=None, plan=None, shared=True):
+    processes = processes or settings.SIMULATION_PROCESSES
+    sampling = sampling or settings.SIMULATION_SAMPLING
+    plan = plan or get_evaluation_plan()
+    results = [None] * len(selected_variable_ids)
+
+    missing = {}
+    stochastic = {}
+    for index, variable_id in enumerate(selected_variable_ids):
+        try:
+            selected_variable = plan.variables[int(variable_id)]
+        except KeyError:
+            logger.error("Variable doesn't exist")
+            continue
+        variable_name = selected_variable.variable_name
+        row_ids = plan.rows_named(variable_name)
+        if not plan.calculable(variable_name):
+            logger.error(f"{variable_name} can't be calculated, it is in or after a dependency cycle")
+            continue
+        stochastic[variable_name] = plan.is_stochastic(row_ids)
+
+        # Keyed by the upstream subgraph, so editing an unrelated variable keeps this result.
+        # Without noise upstream every simulation is the same, whatever their number or seed.
+        if stochastic[variable_name]:
+            key = result_cache.key(
+                variable_name, target_year, num_simulations, seed, processes, sampling, settings.SIMULATION_CHUNK_SIZE,
+                plan.subgraph_hash(row_ids),
+            )
+        else:
+            key = result_cache.key(variable_name, target_year, plan.subgraph_hash(row_ids))
+        results[index] = result_cache.get(key)
+        if results[index] is None:
+            missing.setdefault(variable_name, []).append((index, key))
+
+    if not missing:
+        return results
+
+    # Without a seed the variables still share one, so that the noise of the rows they have
+    # in common is the same (common random numbers) and they can be compared side by side.
+    # All the stochastic variables are simulated together, their shared rows only once.
+    run_seed = np.random.SeedSequence().entropy if seed is None else seed
+    stochastic_names = [variable_name for variable_name in missing if stochastic[variable_name]]
+    deterministic_names = [variable_name for variable_name in missing if not stochastic[variable_name]]
+    if processes > 1 and stochastic_names:
+        statistics = parallel_statistics(plan, stochastic_names, target_year, num_simulations, run_seed, processes, sampling)
+    else:
+        statistics = simulate_statistics_many(
+            plan, stochastic_names, target_year, num_simulations, np.random.default_rng(run_seed),
+            sampling, settings.SIMULATION_CHUNK_SIZE,
+        )
+    # Deterministic variables are calculated once instead of num_simulations times
+    statistics.update(simulate_statistics_many(
+        plan, deterministic_names, target_year, 1, np.random.default_rng(run_seed), sampling, settings.SIMULATION_CHUNK_SIZE,
+    ))
+
+    for variable_name, entries in missing.items():
+        accumulator = statistics[variable_name]
+        if accumulator is None:
+            continue
+        result = (
+            accumulator.mean, accumulator.std,
+            simulation_title([plan.variables[row_id] for row_id in plan.rows_named(variable_name)]),
+            accumulator.bands(),
+        )
+        for index, key in entries:
+            results[index] = result
+            result_cache.set(key, result, shared)
+    return results
+
+# Per-year values as a JSON list, non-finite values (diverging models) as null
+def json_series(values):
+    return [value if math.isfinite(value) else None for value in np.asarray(values, dtype=float).tolist()]
+
+# run_simulations_many served from the PrecomputedResult table (see `manage.py precompute_results`):
+# rows computed from the current upstream subgraph are read as they are, and only the
+# variables whose row is stale or missing are simulated live (left None with live=False).
+# Returns one result (or None) per variable.
+@timed('run_simulations')
+def stored_simulations(selected_variable_ids, target_year, num_simulations=100, sampling=None, live=True, plan=None):
+    sampling = sampling or settings.SIMULATION_SAMPLING
+    plan = plan or get_evaluation_plan()
+    names = {}
+    for variable_id in selected_variable_ids:
+        variable = plan.variables.get(int(variable_id))
+        if variable is not None:
+            names[variable_id] = variable.variable_name
+    stored = {
+        result.variable_name: result
+        for result in PrecomputedResult.objects.filter(
+            variable_name__in=set(names.values()), target_year=target_year, num_simulations=num_simulations, sampling=sampling,
+        )
+    }
+
+    results = [None] * len(selected_variable_ids)
+    stale = []
+    for index, variable_id in enumerate(selected_variable_ids):
+        result = stored.get(names.get(variable_id))
+        if result is None or result.subgraph_hash != plan.subgraph_hash(plan.rows_named(result.variable_name)):
+            stale.append(index)
+            continue
+        results[index] = (
+            np.array(result.mean, dtype=float), np.array(result.std, dtype=float), result.title,
+            {int(percentile): np.array(values, dtype=float) for percentile, values in result.bands.items()},
+        )
+
+    if stale and live:
+        live_results = run_simulations_many(
+            [selected_variable_ids[index] for index in stale], target_year, num_simulations, sampling=sampling, plan=plan,
+        )
+        for index, result in zip(stale, live_results):
+            results[index] = result
+    return results
+
+# The series of the selected variables, from the precomputed results or simulated live when
+# stale or missing, so that an export can stream them without holding the whole model. The
+# plan is loaded once and the variables are read (and simulated, in one shared pass) in
+# batches of 1, 2, 4... up to batch_size: the first variable is yielded as soon as it is
+# calculated, and the later batches still share their upstream rows.
+# Yields (variable, result or None), result as returned by run_simulations.
+def export_series(selected_variable_ids, target_year, num_simulations=100, sampling=None, batch_size=50):
+    plan = get_evaluation_plan()
+    start, size = 0, 1
+    while start < len(selected_variable_ids):
+        batch = selected_variable_ids[start:start + size]
+        results = stored_simulations(batch, target_year, num_simulations, sampling, plan=plan)
+        for variable_id, result in zip(batch, results):
+            yield plan.variables[int(variable_id)], result
+        start += size
+        size = min(size * 2, batch_size)
+
+# Simulates every calculated variable at the current target year and stores the results in
+# PrecomputedResult, batch_size variables per shared simulation pass spread over `processes`
+# (default: every core). With incremental=True only the variables whose row is stale or missing
+# are simulated. Rows of other target years or of variables that no longer exist are removed.
+# Returns (variables computed, variables already up to date, variables that can't be calculated).
+def precompute_results(num_simulations=100, sampling=None, processes=None, incremental=False, batch_size=50, seed=None):
+    sampling = sampling or settings.SIMULATION_SAMPLING
+    processes = processes or os.cpu_count() or 1
+    target_year = get_target_year()
+    plan = get_evaluation_plan()
+
+    # One variable id per name, in dependency order so that a batch shares as many rows as possible
+    ordered, _ = plan.topological_order(plan.variables)
+    representatives = {}
+    for row_id in ordered + sorted(set(plan.variables) - set(ordered)):
+        variable = plan.variables[row_id]
+        if variable.variable_type == Variable.CALCULATED:
+            representatives.setdefault(variable.variable_name, row_id)
+
+    PrecomputedResult.objects.exclude(target_year=target_year).delete()
+    PrecomputedResult.objects.exclude(variable_name__in=list(representatives)).delete()
+    stored = {result.variable_name: result for result in PrecomputedResult.objects.filter(target_year=target_year)}
+
+    pending, up_to_date, failed = [], 0, 0
+    for variable_name in representatives:
+        if not plan.calculable(variable_name):
+            failed += 1
+            continue
+        row_ids = plan.rows_named(variable_name)
+        result = stored.get(variable_name)
+        if incremental and result is not None and (
+            result.num_simulations == num_simulations and result.sampling == sampling
+            and result.subgraph_hash == plan.subgraph_hash(row_ids)
+        ):
+            up_to_date += 1
+        else:
+            pending.append(variable_name)
+
+    computed = 0
+    for start in range(0, len(pending), batch_size):
+        batch = pending[start:start + batch_size]
+        results = run_simulations_many(
+            [representatives[variable_name] for variable_name in batch], target_year, num_simulations, seed, processes, sampling,
+        )
+        for variable_name, result in zip(batch, results):
+            if result is None:
+                failed += 1
+                continue
+            mean_values, std_dev_values, title, bands = result
+            PrecomputedResult.objects.update_or_create(
+                variable_name=variable_name, target_year=target_year,
+                defaults={
+                    'num_simulations': num_simulations,
+                    'sampling': sampling,
+                    'subgraph_hash': plan.subgraph_hash(plan.rows_named(variable_name)),
+                    'title': title,
+                    'mean': json_series(mean_values),
+                    'std': json_series(std_dev_values),
+                    'bands': {str(percentile): json_series(values) for percentile, values in bands.items()},
+                },
+            )
+            computed += 1
+    return computed, up_to_date, failed
+
+# Adaptive run_simulations: runs batches of batch_size simulations until the standard
+# errors of every year's mean and std are within `tolerance` of the mean, or
+# max_simulations have run. Returns (mean, std, title, bands, number of simulations used).
+@timed('run_simulations')
+def run_adaptive_simulations(selected_variable_id, target_year, tolerance=None, max_simulations=None, batch_size=100, seed=None, sampling=None):
+    tolerance = tolerance or settings.SIMULATION_TOLERANCE
+    max_simulations = max_simulations or settings.SIMULATION_MAX_SIMULATIONS
+    sampling = sampling or settings.SIMULATION_SAMPLING
+    plan = get_evaluation_plan()
+    try:
+        selected_variable = plan.variables[int(selected_variable_id)]
+    except KeyError:
+        logger.error("Variable doesn't exist")
+        return None
+    variable_name = selected_variable.variable_name
+    row_ids = plan.rows_named(variable_name)
+
+    key = result_cache.key(variable_name, target_year, 'adaptive', tolerance, max_simulations, batch_size, seed, sampling, plan.subgraph_hash(row_ids))
+    result = result_cache.get(key)
+    if result is not None:
+        return result
+
+    try:
+        accumulator = adaptive_statistics(
+            plan, variable_name, target_year, np.random.default_rng(seed), tolerance, batch_size, max_simulations, sampling
+        )
+    except DependencyCycleError as e:
+        logger.error(str(e))
+        return None
+    if accumulator is None:
+        return None
+
+    result = (
+        accumulator.mean, accumulator.std, simulation_title([plan.variables[row_id] for row_id in row_ids]),
+        accumulator.bands(), accumulator.count,
+    )
+    result_cache.set(key, result)
+    return result
+
+# First-order propagation of the mean and variance through the model instead of
+# Monte Carlo: one deterministic pass, with normal P5/P50/P95 bands around the mean.
+# Returns (mean, std, title, bands) like run_simulations.
+@timed('run_simulations')
+def run_analytic_simulations(selected_variable_id, target_year):
+    plan = get_evaluation_plan()
+    try:
+        selected_variable = plan.variables[int(selected_variable_id)]
+    except KeyError:
+        logger.error("Variable doesn't exist")
+        return None
+    variable_name = selected_variable.variable_name
+    row_ids = plan.rows_named(variable_name)
+
+    key = result_cache.key(variable_name, target_year, 'analytic', plan.subgraph_hash(row_ids))
+    result = result_cache.get(key)
+    if result is not None:
+        return result
+
+    try:
+        moments = analytic_moments(plan, variable_name, target_year)
+    except DependencyCycleError as e:
+        logger.error(str(e))
+        return None
+    if moments is None:
+        return None
+
+    mean_values, std_dev_values, bands = moments
+    result = (mean_values, std_dev_values, simulation_title([plan.variables[row_id] for row_id in row_ids]), bands)
+    result_cache.set(key, result)
+    return result
+
+def run_simulations_loop(selected_variable_id, target_year, num_simulations=100):
     try:
         all_simulated_values = []
-        title = []
         selected_variable = get_variable_by_id(selected_variable_id)
         calculated_variables_of_selected = Variable.objects.filter(variable_name=selected_variable.variable_name)
         
@@ -111,18 +406,9 @@ def run_simulations(selected_variable_id, target_year, num_simulations=100):
             yearly_calculate_value = calc_yearly_values(variable, target_year=target_year)
             if yearly_calculate_value is None:
                 return None
-            if len(title) == 0:
-                if variable.determining_value:
-                    title.append(f'(<b>{variable.variable_name}</b> according to the <b>{variable.determining_value.variable_name}</b>)')
-                else:
-                    title.append(f'(<b>{variable.variable_name}</b>)')
-            else:
-                print(title[-1])
-                title[-1] = title[-1][:-1]
-                title.append(f'& <b>{variable.determining_value.variable_name}</b>)')
+        title = simulation_title(calculated_variables_of_selected)
 
         for index in range(num_simulations):
-            print(index + 1)
             simulation_results = []
             for variable in calculated_variables_of_selected:
                 yearly_values = calc_yearly_values(variable, target_year)
@@ -135,15 +421,49 @@ def run_simulations(selected_variable_id, target_year, num_simulations=100):
         all_simulated_values = np.array(all_simulated_values)
         mean_values = np.mean(all_simulated_values, axis=0)
         std_dev_values = np.std(all_simulated_values, axis=0)
-        print('std dev values-->', std_dev_values)
-        return mean_values, std_dev_values, title
+        bands = dict(zip(BAND_PERCENTILES, np.percentile(all_simulated_values, BAND_PERCENTILES, axis=0)))
+        return mean_values, std_dev_values, title, bands
 
     except Variable.DoesNotExist:
         logger.error("Variable doesn't exist")
         return None
 
-def display_graph(first_selected_variable_id, second_selected_variable_id):
-    print('started----------------------------------------------------------------------------------------!!!!!!')
+# Runs both engines on the same variable and compares their mean and std per year.
+# The z-scores measure each difference in units of its Monte Carlo standard error,
+# so values well below 3 mean the engines agree.
+def compare_engines(selected_variable_id, target_year, num_simulations=100, seed=None):
+    # The vectorized engine runs first: it detects dependency cycles, the recursive loop doesn't
+    vectorized_result = run_simulations(selected_variable_id, target_year, num_simulations, engine='vectorized', seed=seed)
+    if vectorized_result is None:
+        return None
+    loop_result = run_simulations(selected_variable_id, target_year, num_simulations, engine='loop')
+    if loop_result is None:
+        return None
+
+    loop_mean, loop_std, *_ = loop_result
+    vectorized_mean, vectorized_std, *_ = vectorized_result
+    # Rounding leaves a tiny std even where nothing is random (the vectorized engine's
+    # deterministic fast path has none), so those years are compared on their mean only
+    threshold = 1e-9 * np.abs(loop_mean)
+    deterministic_years = (loop_std <= threshold) & (vectorized_std <= threshold)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_error = np.sqrt((loop_std ** 2 + vectorized_std ** 2) / num_simulations)
+        std_error = np.sqrt((loop_std ** 2 + vectorized_std ** 2) / (2 * (num_simulations - 1)))
+        mean_z = np.where(~deterministic_years & (mean_error > 0), np.abs(loop_mean - vectorized_mean) / mean_error, 0)
+        std_z = np.where(~deterministic_years & (std_error > 0), np.abs(loop_std - vectorized_std) / std_error, 0)
+        relative_error = np.abs(loop_mean - vectorized_mean) / np.maximum(np.abs(loop_mean), 1e-12)
+
+    return {
+        'loop_mean': loop_mean,
+        'loop_std': loop_std,
+        'vectorized_mean': vectorized_mean,
+        'vectorized_std': vectorized_std,
+        'max_mean_z': float(np.max(mean_z)),
+        'max_std_z': float(np.max(std_z)),
+        'max_deterministic_relative_error': float(np.max(relative_error[deterministic_years], initial=0)),
+    }
+
+def graph_figure(first_selected_variable_id, second_selected_variable_id, engine='vectorized'):
     first_variable = get_variable_by_id(first_selected_variable_id)
     second_variable = get_variable_by_id(second_selected_variable_id)
     try:    
@@ -154,8 +474,15 @@ def display_graph(first_selected_variable_id, second_selected_variable_id):
 
     years = list(range(2023, target_year + 1))
 
-    first_mean, first_std_dev, title1 = run_simulations(first_selected_variable_id, target_year)
-    second_mean, second_std_dev ,title2 = run_simulations(second_selected_variable_id, target_year)
+    if engine == 'analytic':
+        first_result = run_simulations(first_selected_variable_id, target_year, engine=engine)
+        second_result = run_simulations(second_selected_variable_id, target_year, engine=engine)
+    else:
+        first_result, second_result = stored_simulations([first_selected_variable_id, second_selected_variable_id], target_year)
+    if first_result is None or second_result is None:
+        return None
+    first_mean, first_std_dev, title1, first_bands = first_result
+    second_mean, second_std_dev, title2, second_bands = second_result
 
     fig = make_subplots(specs=[[{"secondary_y": True}]])
     fig.add_trace(
@@ -170,6 +497,11 @@ def display_graph(first_selected_variable_id, second_selected_variable_id):
         go.Scatter(x=years, y=first_mean - first_std_dev, name=f'{first_variable.variable_name} -1 Std Dev', line_shape='spline',
         line=dict(dash='dash')), secondary_y=False
     )
+    for percentile in (5, 95):
+        fig.add_trace(
+            go.Scatter(x=years, y=first_bands[percentile], name=f'{first_variable.variable_name} P{percentile}', line_shape='spline',
+            line=dict(dash='dot')), secondary_y=False
+        )
     fig.add_trace(
         go.Scatter(x=years, y=second_mean, name=second_variable.variable_name, line_shape='spline'),
         secondary_y=True,
@@ -182,6 +514,11 @@ def display_graph(first_selected_variable_id, second_selected_variable_id):
         go.Scatter(x=years, y=second_mean - second_std_dev, name=f'{second_variable.variable_name} -1 Std Dev', line_shape='spline',
         line=dict(dash='dash')), secondary_y=True
     )
+    for percentile in (5, 95):
+        fig.add_trace(
+            go.Scatter(x=years, y=second_bands[percentile], name=f'{second_variable.variable_name} P{percentile}', line_shape='spline',
+            line=dict(dash='dot')), secondary_y=True
+        )
 
     title = title1 + ['VS'] + title2
 
@@ -193,6 +530,208 @@ def display_graph(first_selected_variable_id, second_selected_variable_id):
         template='plotly_dark'
     )
 
+    return fig
+
+@timed('display_graph')
+def display_graph(first_selected_variable_id, second_selected_variable_id, engine='vectorized'):
+    fig = graph_figure(first_selected_variable_id, second_selected_variable_id, engine)
+    if fig is None:
+        return None
     graph_html = pio.to_html(fig, full_html=False)
-    print('Done----------------------------------------------------------------------!!!!!!!')
     return graph_html
+
+# Values rounded to 6 significant digits, plenty for plotting and a fraction of the JSON size,
+# non-finite values (diverging models) as null like json_series
+def compact(values):
+    return [float(f'{value:.6g}') if math.isfinite(value) else None for value in values]
+
+# Years, mean and std of every selected variable, for the graph page to plot in the browser.
+# engine='analytic' approximates them without simulating, see run_analytic_simulations.
+@timed('graph_series')
+def graph_series(selected_variable_ids, tolerance=None, sampling=None, engine='vectorized'):
+    try:
+        target_year = get_target_year()
+    except TargetYear.DoesNotExist:
+        logger.error("Target year doesn't exist")
+        return None
+
+    # A tolerance (argument or SIMULATION_TOLERANCE setting) switches to adaptive simulations
+    tolerance = tolerance or settings.SIMULATION_TOLERANCE
+    if engine == 'analytic':
+        results = [
+            None if result is None else (*result, 0)
+            for result in (run_analytic_simulations(variable_id, target_year) for variable_id in selected_variable_ids)
+        ]
+    elif tolerance:
+        results = [
+            run_adaptive_simulations(variable_id, target_year, tolerance, sampling=sampling)
+            for variable_id in selected_variable_ids
+        ]
+    else:
+        results = [
+            None if result is None else (*result, 100)
+            for result in stored_simulations(selected_variable_ids, target_year, sampling=sampling)
+        ]
+
+    series = []
+    for variable_id, result in zip(selected_variable_ids, results):
+        if result is None:
+            return None
+        series.append(series_entry(get_variable_by_id(variable_id), *result))
+
+    return {'years': list(range(2023, target_year + 1)), 'variables': series}
+
+# graph_series read from the PrecomputedResult table only, for pages that can skip the
+# background job. None unless every variable has a fresh row.
+def stored_graph_series(selected_variable_ids, sampling=None):
+    try:
+        target_year = get_target_year()
+    except TargetYear.DoesNotExist:
+        return None
+    results = stored_simulations(selected_variable_ids, target_year, sampling=sampling, live=False)
+    if any(result is None for result in results):
+        return None
+    return {
+        'years': list(range(2023, target_year + 1)),
+        'variables': [
+            series_entry(get_variable_by_id(variable_id), *result, 100)
+            for variable_id, result in zip(selected_variable_ids, results)
+        ],
+    }
+
+# One variable's plotted series, as returned by graph_series and scenario_series
+def series_entry(variable, mean_values, std_dev_values, title, bands, num_simulations):
+    return {
+        'id': variable.id,
+        'name': variable.variable_name,
+        'title': title,
+        'simulations': num_simulations,
+        'mean': compact(mean_values),
+        'std': compact(std_dev_values),
+        'bands': {f'p{percentile}': compact(values) for percentile, values in bands.items()},
+    }
+
+# What-if scenario: the series of the selected variables with some input values and
+# coefficients overridden (see EvaluationPlan.with_overrides) and/or another target year,
+# evaluated in memory without writing anything to the database. Variables the scenario
+# doesn't change come straight from the baseline's cached results. The others are paired
+# with the baseline using common random numbers, and also get the baseline series and the
+# mean, std and P5/P95 of the per-simulation difference scenario - baseline.
+# Raises ValueError for invalid overrides, returns None when the model can't be calculated.
+@timed('scenario_series')
+def scenario_series(selected_variable_ids, inputs=None, coefficients=None, num_simulations=100, seed=None, sampling=None, target_year=None):
+    sampling = sampling or settings.SIMULATION_SAMPLING
+    try:
+        baseline_target_year = get_target_year()
+    except TargetYear.DoesNotExist:
+        logger.error("Target year doesn't exist")
+        return None
+    target_year = target_year or baseline_target_year
+    if target_year <= 2023:
+        raise ValueError('The target year must be after 2023')
+
+    baseline = get_evaluation_plan()
+    if any(int(variable_id) not in baseline.variables for variable_id in selected_variable_ids):
+        raise ValueError("Variable doesn't exist")
+    scenario = baseline.with_overrides(inputs, coefficients)
+    baseline_fingerprints, _ = baseline.fingerprints()
+    scenario_fingerprints, _ = scenario.fingerprints()
+    paired_seed = np.random.SeedSequence().entropy if seed is None else seed
+
+    series = []
+    for variable_id in selected_variable_ids:
+        variable = scenario.variables[int(variable_id)]
+        row_ids = scenario.rows_named(variable.variable_name)
+        changed = target_year != baseline_target_year or any(
+            baseline_fingerprints[row_id] != scenario_fingerprints[row_id] for row_id in row_ids
+        )
+        if not changed:
+            result = run_simulations_many([variable_id], target_year, num_simulations, seed=seed, sampling=sampling)[0]
+            if result is None:
+                return None
+            series.append({**series_entry(variable, *result, num_simulations), 'changed': False})
+            continue
+
+        try:
+            statistics = paired_statistics(
+                baseline, scenario, variable.variable_name, baseline_target_year, target_year,
+                num_simulations if scenario.is_stochastic(row_ids) or baseline.is_stochastic(row_ids) else 1,
+                paired_seed, sampling, settings.SIMULATION_CHUNK_SIZE,
+            )
+        except DependencyCycleError as e:
+            logger.error(str(e))
+            return None
+        if statistics is None:
+            return None
+        first, second, difference = statistics
+        title = simulation_title([scenario.variables[row_id] for row_id in row_ids])
+        entry = series_entry(variable, second.mean, second.std, title, second.bands(), num_simulations)
+        entry['changed'] = True
+        entry['baseline'] = {'mean': compact(first.mean), 'std': compact(first.std)}
+        difference_bands = difference.bands()
+        entry['difference'] = {
+            'mean': compact(difference.mean),
+            'std': compact(difference.std),
+            'p5': compact(difference_bands[5]),
+            'p95': compact(difference_bands[95]),
+        }
+        series.append(entry)
+
+    return {
+        'years': list(range(2023, target_year + 1)),
+        'baseline_years': list(range(2023, baseline_target_year + 1)),
+        'variables': series,
+    }
+
+# Runs the simulations of every selected variable in chunks and yields the running
+# mean and std per year after each chunk, so the caller can stream them and stop early
+def stream_simulations(selected_variable_ids, num_simulations=100, chunk_size=10, seed=None, sampling=None):
+    sampling = sampling or settings.SIMULATION_SAMPLING
+    try:
+        target_year = get_target_year()
+    except TargetYear.DoesNotExist:
+        yield {'error': "Target year doesn't exist"}
+        return
+
+    plan = get_evaluation_plan()
+    try:
+        selected_variables = [plan.variables[int(variable_id)] for variable_id in selected_variable_ids]
+    except KeyError:
+        yield {'error': "Variable doesn't exist"}
+        return
+
+    # Without noise upstream of any selected variable, one chunk of one simulation is exact
+    if not plan.is_stochastic([row_id for variable in selected_variables for row_id in plan.rows_named(variable.variable_name)]):
+        chunk_size = num_simulations = 1
+
+    # Every chunk simulates all the selected variables in one pass, from the same draws
+    rng = np.random.default_rng(seed)
+    variable_names = list(dict.fromkeys(variable.variable_name for variable in selected_variables))
+    accumulators = {variable_name: SimulationStatistics() for variable_name in variable_names}
+    completed = 0
+    while completed < num_simulations:
+        chunk = min(chunk_size, num_simulations - completed)
+        try:
+            statistics = simulate_statistics_many(plan, variable_names, target_year, chunk, rng, sampling, chunk)
+        except DependencyCycleError as e:
+            yield {'error': str(e)}
+            return
+        for variable_name, chunk_statistics in statistics.items():
+            if chunk_statistics is None:
+                yield {'error': f'{variable_name} could not be calculated'}
+                return
+            accumulators[variable_name].merge(chunk_statistics)
+
+        series = []
+        for variable in selected_variables:
+            accumulator = accumulators[variable.variable_name]
+            series.append({
+                'id': variable.id,
+                'name': variable.variable_name,
+                'title': simulation_title([plan.variables[row_id] for row_id in plan.rows_named(variable.variable_name)]),
+                'mean': compact(accumulator.mean),
+                'std': compact(accumulator.std),
+                'bands': {f'p{percentile}': compact(values) for percentile, values in accumulator.bands().items()},
+            })
+        completed += chunk
+        yield {'years': list(range(2023, target_year + 1)), 'simulations': completed, 'variables': series}
@@ -0,0 +1,136 @@
+import cProfile
+import functools
+import json
+import logging
+import re
+import time
+from contextlib import ExitStack, contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+current_timings = ContextVar('current_timings', default=None)
+
+
+class RequestTimings:
+    def __init__(self):
+        self.stages = {}
+        self.active = set()
+        self.queries = 0
+        self.db_time = 0.0
+        self.total = 0.0
+
+    # Wraps every query of the request, see connection.execute_wrapper
+    def database(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.db_time += time.perf_counter() - started
+
+    def as_dict(self):
+        return {
+            'total_ms': round(self.total * 1000, 2),
+            'queries': self.queries,
+            'db_ms': round(self.db_time * 1000, 2),
+            'stages_ms': {stage: round(elapsed * 1000, 2) for stage, elapsed in self.stages.items()},
+        }
+
+    # Server-Timing header value
+    def header(self):
+        metrics = [f'db;dur={self.db_time * 1000:.2f};desc="{self.queries} queries"']
+        metrics += [f'{stage};dur={elapsed * 1000:.2f}' for stage, elapsed in self.stages.items()]
+        metrics.append(f'total;dur={self.total * 1000:.2f}')
+        return ', '.join(metrics)
+
+
+# Collects the timings and queries of everything run inside the block (in this thread)
+@contextmanager
+def measure():
+    timings = RequestTimings()
+    token = current_timings.set(timings)
+    started = time.perf_counter()
+    try:
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(timings.database))
+            yield timings
+    finally:
+        timings.total = time.perf_counter() - started
+        current_timings.reset(token)
+
+
+# Adds the time spent in the decorated function to the current request's `stage`.
+# Nested or recursive calls of the same stage are only counted once.
+def timed(stage):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            timings = current_timings.get()
+            if timings is None or stage in timings.active:
+                return function(*args, **kwargs)
+
+            timings.active.add(stage)
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                timings.active.discard(stage)
+                timings.stages[stage] = timings.stages.get(stage, 0.0) + time.perf_counter() - started
+        return wrapper
+    return decorator
+
+
+# Reports where each request spent its time: a Server-Timing header (shown by the
+# browser dev tools), one JSON log line, and a cProfile dump for requests slower than
+# SERVER_TIMING_PROFILE_THRESHOLD milliseconds when that setting is set.
+class ServerTimingMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.profile_threshold = getattr(settings, 'SERVER_TIMING_PROFILE_THRESHOLD', 0)
+        self.profile_dir = getattr(settings, 'SERVER_TIMING_PROFILE_DIR', None)
+
+    def __call__(self, request):
+        profile = self.start_profile()
+        try:
+            with measure() as timings:
+                response = self.get_response(request)
+        finally:
+            if profile is not None:
+                profile.disable()
+
+        if profile is not None and timings.total * 1000 > self.profile_threshold:
+            self.dump_profile(profile, request)
+
+        response['Server-Timing'] = timings.header()
+        logger.info(json.dumps({
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            **timings.as_dict(),
+        }))
+        return response
+
+    def start_profile(self):
+        if not self.profile_threshold or not self.profile_dir:
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler is already running in this process
+            return None
+        return profile
+
+    def dump_profile(self, profile, request):
+        profile_dir = Path(self.profile_dir)
+        profile_dir.mkdir(parents=True, exist_ok=True)
+        name = re.sub(r'[^A-Za-z0-9]+', '_', request.path).strip('_') or 'root'
+        path = profile_dir / f'{time.strftime("%Y%m%d-%H%M%S")}-{name}.prof'
+        profile.dump_stats(path)
+        logger.warning(f'Slow request {request.path} profiled to {path}')
@@ -0,0 +1,198 @@
+import atexit
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from uuid import uuid4
+
+import django
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+
+from .instrumentation import measure
+
+logger = logging.getLogger(__name__)
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+# How long finished jobs can still be polled (seconds)
+JOB_RESULT_TIMEOUT = 60 * 10
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+class JobTimeout(Exception):
+    pass
+
+
+# Runs in a job process: sets Django up once, then runs the jobs sent over `connection` one
+# after another and sends back (True, result, timings) or (False, error message, None)
+def serve_jobs(connection):
+    # Its own process group, so that a timed-out job is killed with any pool it started
+    os.setpgrp()
+    django.setup()
+    while True:
+        try:
+            function, args = connection.recv()
+        except EOFError:
+            return
+        try:
+            with measure() as timings:
+                result = function(*args)
+            connection.send((True, result, timings.as_dict()))
+        except Exception as e:
+            logger.exception(f'Simulation job {function.__name__} failed')
+            connection.send((False, str(e), None))
+        finally:
+            connections.close_all()
+
+
+# A spawned process that runs one job at a time for a job thread. It is kept between jobs,
+# so Django and the imports are only set up once, and killed (with its process group)
+# when a job runs past its timeout, then started again for the next job.
+class JobProcess:
+    def __init__(self):
+        self.process = None
+        self.connection = None
+
+    def run(self, function, args, timeout):
+        if self.process is None or not self.process.is_alive():
+            self.start()
+        self.connection.send((function, args))
+        if not self.connection.poll(max(timeout, 0)):
+            self.stop()
+            raise JobTimeout()
+        try:
+            return self.connection.recv()
+        except EOFError:
+            # The process died during the job (e.g. out of memory)
+            self.stop()
+            raise
+
+    def start(self):
+        context = multiprocessing.get_context('spawn')
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(target=serve_jobs, args=(child_connection,), name='simulation-job')
+        self.process.start()
+        child_connection.close()
+
+    def stop(self):
+        if self.process is None:
+            return
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            # Not in its own group yet
+            pass
+        self.process.kill()
+        self.process.join()
+        self.connection.close()
+        self.process = None
+
+
+# Runs simulation jobs outside the web worker, no broker needed.
+#
+# Job states live in the shared cache, so any gunicorn worker can answer a poll
+# for a job another worker is running. At most `workers` jobs run and `max_pending`
+# wait; further submissions are refused instead of piling up. Each running job has a
+# thread waiting on its own job process (see JobProcess), and a job running past its
+# timeout is reported as failed and killed, which frees its slot and its CPU.
+class JobQueue:
+    def __init__(self, workers, max_pending, timeout):
+        self.workers = workers
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(workers + max_pending)
+        self.executor = None
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.processes = []
+
+    # Created lazily so every forked gunicorn worker gets its own threads
+    def get_executor(self):
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='simulation-job')
+                atexit.register(self.shutdown)
+            return self.executor
+
+    # The job process of the current job thread
+    def get_process(self):
+        process = getattr(self.local, 'process', None)
+        if process is None:
+            process = self.local.process = JobProcess()
+            with self.lock:
+                self.processes.append(process)
+        return process
+
+    def shutdown(self):
+        with self.lock:
+            for process in self.processes:
+                process.stop()
+
+    def submit(self, function, *args):
+        if not self.slots.acquire(blocking=False):
+            raise JobQueueFull()
+
+        job_id = uuid4().hex
+        self.store(job_id, {'status': QUEUED, 'submitted': time.time()})
+        try:
+            self.get_executor().submit(self.run, job_id, function, args)
+        except Exception:
+            self.slots.release()
+            raise
+        return job_id
+
+    def run(self, job_id, function, args):
+        deadline = time.time() + self.timeout
+        try:
+            self.store(job_id, {'status': RUNNING, 'deadline': deadline})
+            succeeded, result, timings = self.get_process().run(function, args, deadline - time.time())
+            if not succeeded:
+                self.store(job_id, {'status': FAILED, 'error': result})
+                return
+            logger.info(json.dumps({'job': job_id, 'function': function.__name__, **timings}))
+            if result is None:
+                self.store(job_id, {'status': FAILED, 'error': 'The simulation could not be calculated'})
+            else:
+                self.store(job_id, {'status': DONE, 'result': result})
+        except JobTimeout:
+            logger.error(f'Simulation job {job_id} killed after its {self.timeout}s timeout')
+            self.store(job_id, {'status': FAILED, 'error': f'The simulation timed out after {self.timeout}s'})
+        except Exception as e:
+            logger.exception(f'Simulation job {job_id} failed')
+            self.store(job_id, {'status': FAILED, 'error': str(e)})
+        finally:
+            connections.close_all()
+            self.slots.release()
+
+    def status(self, job_id):
+        job = cache.get(self.key(job_id))
+        if job is None:
+            return None
+        if job['status'] == RUNNING and time.time() > job['deadline']:
+            return {'status': FAILED, 'error': f'The simulation timed out after {self.timeout}s'}
+        return job
+
+    def store(self, job_id, job):
+        cache.set(self.key(job_id), job, JOB_RESULT_TIMEOUT)
+
+    @staticmethod
+    def key(job_id):
+        return f'world_model:job:{job_id}'
+
+
+job_queue = JobQueue(
+    workers=settings.SIMULATION_JOB_WORKERS,
+    max_pending=settings.SIMULATION_JOB_QUEUE_SIZE,
+    timeout=settings.SIMULATION_JOB_TIMEOUT,
+)
@@ -0,0 +1,68 @@
+import os
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from variables.batch import OUTPUT_FORMATS, match_variables, open_writer, run_batch
+from variables.functions import get_evaluation_plan, get_target_year
+from variables.models import TargetYear
+from variables.sampling import SAMPLING_METHODS
+
+
+class Command(BaseCommand):
+    help = (
+        'Simulates calculated variables at several target years and seeds on every core and '
+        'streams the per-year mean, std and bands to a Parquet, Arrow or .npz file.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('variables', nargs='*', help="Variable names or globs, e.g. 'Energy*' (default: every calculated variable)")
+        parser.add_argument('--output', required=True, help='File to write, its extension picks the format (.parquet, .arrow, .npz)')
+        parser.add_argument('--format', choices=OUTPUT_FORMATS, help='Output format, when the extension is not enough')
+        parser.add_argument('--target-year', type=int, action='append', dest='target_years', help='Repeatable (default: the current target year)')
+        parser.add_argument('--seed', type=int, action='append', dest='seeds', help='Repeatable (default: 0)')
+        parser.add_argument('--simulations', type=int, default=100)
+        parser.add_argument('--sampling', choices=SAMPLING_METHODS, default=settings.SIMULATION_SAMPLING)
+        parser.add_argument('--processes', type=int, default=os.cpu_count(), help='Worker processes (default: every core)')
+        parser.add_argument('--batch-size', type=int, default=50, help='Variables simulated together in one pass')
+
+    def handle(self, *args, **options):
+        try:
+            target_years = options['target_years'] or [get_target_year()]
+        except TargetYear.DoesNotExist:
+            raise CommandError("Target year doesn't exist, pass --target-year")
+        if min(target_years) <= 2023:
+            raise CommandError('Target years must be after 2023')
+
+        plan = get_evaluation_plan()
+        variables = match_variables(plan, options['variables'] or ['*'])
+        if not variables:
+            raise CommandError('No calculated variable matches')
+
+        try:
+            writer = open_writer(options['output'], options['format'])
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        started = time.perf_counter()
+        try:
+            variable_years, failed = run_batch(
+                plan, variables, target_years, options['seeds'] or [0], writer,
+                num_simulations=options['simulations'],
+                sampling=options['sampling'],
+                processes=options['processes'] or 1,
+                batch_size=max(options['batch_size'], 1),
+                chunk_size=settings.SIMULATION_CHUNK_SIZE,
+            )
+        finally:
+            writer.close()
+        elapsed = time.perf_counter() - started
+
+        self.stdout.write(self.style.SUCCESS(
+            f"{len(variables)} variable(s) x {len(target_years)} target year(s) x {len(options['seeds'] or [0])} seed(s): "
+            f'{variable_years} variable-years in {elapsed:.2f}s ({variable_years / elapsed:,.0f} variable-years/s), '
+            f"written to {options['output']}"
+        ))
+        if failed:
+            self.stdout.write(self.style.WARNING(f'{failed} variable run(s) could not be calculated'))
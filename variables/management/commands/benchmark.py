@@ -0,0 +1,97 @@
+import json
+import platform
+import time
+from pathlib import Path
+
+import django
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from variables.benchmarks import SCENARIOS, run_benchmarks
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmarks the simulation engine and the heavy views on synthetic models, in a throwaway '
+        'test database. Results are saved as JSON and can be compared with an earlier run.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scenario', action='append', choices=SCENARIOS, help='Scenario to run (default: all)')
+        parser.add_argument('--size', type=int, default=100, help='Fan-in width, chain depth or number of inputs')
+        parser.add_argument('--target-year', type=int, default=2150)
+        parser.add_argument('--simulations', type=int, default=100)
+        parser.add_argument('--repeat', type=int, default=3)
+        parser.add_argument('--include-loop', action='store_true', help='Also time the original loop engine (slow)')
+        parser.add_argument(
+            '--accuracy-simulations', type=int, default=10000,
+            help='Monte Carlo simulations the analytic engine is checked against (0 to skip)',
+        )
+        parser.add_argument('--output', help='JSON file to write (default: benchmarks/<timestamp>.json)')
+        parser.add_argument('--compare', help='Earlier JSON results to compare against')
+        parser.add_argument('--max-regression', type=float, default=1.25, help='Largest accepted slowdown ratio')
+        parser.add_argument('--noinput', action='store_false', dest='interactive')
+
+    def handle(self, *args, **options):
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=not options['interactive'], serialize=False)
+        try:
+            results = run_benchmarks(
+                scenarios=options['scenario'] or SCENARIOS,
+                size=options['size'],
+                target_year=options['target_year'],
+                num_simulations=options['simulations'],
+                repeat=options['repeat'],
+                include_loop=options['include_loop'],
+                accuracy_simulations=options['accuracy_simulations'],
+            )
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        for result in results:
+            self.stdout.write(
+                f"{result['scenario']:<12} {result['name']:<26} {result['wall_s'] * 1000:>10.1f} ms "
+                f"{result['peak_memory_mb']:>8.1f} MB {result['queries']:>6} queries"
+            )
+            if 'analytic_mean_error' in result:
+                self.stdout.write(
+                    f"{'':<12} {'  vs Monte Carlo':<26} mean off by {result['analytic_mean_error']:.3f} std, "
+                    f"std off by {result['analytic_std_error']:.1%} ({result['analytic_reference_simulations']} simulations)"
+                )
+
+        output = Path(options['output'] or settings.BASE_DIR / 'benchmarks' / f'{time.strftime("%Y%m%d-%H%M%S")}.json')
+        output.parent.mkdir(parents=True, exist_ok=True)
+        output.write_text(json.dumps({
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'numpy': np.__version__,
+            'database': connection.vendor,
+            'simulation_processes': settings.SIMULATION_PROCESSES,
+            'results': results,
+        }, indent=2))
+        self.stdout.write(f'Results saved to {output}')
+
+        if options['compare']:
+            self.compare(results, options['compare'], options['max_regression'])
+
+    def compare(self, results, path, max_regression):
+        baseline = {
+            (result['scenario'], result['name'], result['size'], result['target_year']): result
+            for result in json.loads(Path(path).read_text())['results']
+        }
+        regressions = 0
+        for result in results:
+            previous = baseline.get((result['scenario'], result['name'], result['size'], result['target_year']))
+            if previous is None:
+                continue
+            ratio = result['wall_s'] / previous['wall_s'] if previous['wall_s'] else 1.0
+            regressed = ratio > max_regression
+            regressions += regressed
+            style = self.style.ERROR if regressed else self.style.SUCCESS
+            self.stdout.write(style(f"{result['scenario']:<12} {result['name']:<26} {ratio:>6.2f}x"))
+
+        if regressions:
+            raise CommandError(f'{regressions} benchmark(s) are more than {max_regression}x slower than {path}')
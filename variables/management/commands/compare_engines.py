@@ -0,0 +1,48 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from variables.functions import compare_engines, get_target_year
+from variables.models import TargetYear, Variable
+
+
+class Command(BaseCommand):
+    help = 'Checks that the vectorized simulation engine matches the original loop (mean and std per year).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('variables', nargs='*', help='Variable names to check (default: every calculated variable)')
+        parser.add_argument('--simulations', type=int, default=100)
+        parser.add_argument('--seed', type=int, default=None)
+        parser.add_argument('--tolerance', type=float, default=4.0, help='Largest accepted z-score')
+
+    def handle(self, *args, **options):
+        try:
+            target_year = get_target_year()
+        except TargetYear.DoesNotExist:
+            raise CommandError("Target year doesn't exist")
+
+        names = options['variables'] or Variable.objects.filter(variable_type=Variable.CALCULATED).values_list('variable_name', flat=True)
+        failures = 0
+        for name in dict.fromkeys(names):
+            variable = Variable.objects.filter(variable_name=name).first()
+            if variable is None:
+                raise CommandError(f'Variable {name} not found')
+
+            started = time.perf_counter()
+            comparison = compare_engines(variable.id, target_year, options['simulations'], seed=options['seed'])
+            elapsed = time.perf_counter() - started
+            if comparison is None:
+                self.stdout.write(self.style.WARNING(f'{name}: could not be simulated'))
+                continue
+
+            worst = max(comparison['max_mean_z'], comparison['max_std_z'])
+            agrees = worst <= options['tolerance'] and comparison['max_deterministic_relative_error'] < 1e-9
+            failures += not agrees
+            style = self.style.SUCCESS if agrees else self.style.ERROR
+            self.stdout.write(style(
+                f"{name}: mean z={comparison['max_mean_z']:.2f}, std z={comparison['max_std_z']:.2f}, "
+                f"deterministic error={comparison['max_deterministic_relative_error']:.2e} ({elapsed:.2f}s)"
+            ))
+
+        if failures:
+            raise CommandError(f'{failures} variable(s) differ between the engines')
@@ -0,0 +1,44 @@
+import os
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from variables.functions import precompute_results
+from variables.models import TargetYear
+from variables.sampling import SAMPLING_METHODS
+
+
+class Command(BaseCommand):
+    help = (
+        'Simulates every calculated variable at the current target year and stores the per-year '
+        'mean, std and bands, which the graph pages then read instead of simulating.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--simulations', type=int, default=100)
+        parser.add_argument('--sampling', choices=SAMPLING_METHODS, default=settings.SIMULATION_SAMPLING)
+        parser.add_argument('--processes', type=int, default=os.cpu_count(), help='Worker processes (default: every core)')
+        parser.add_argument('--incremental', action='store_true', help='Only recompute variables whose upstream changed')
+        parser.add_argument('--batch-size', type=int, default=50, help='Variables simulated together in one pass')
+        parser.add_argument('--seed', type=int, default=None)
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        try:
+            computed, up_to_date, failed = precompute_results(
+                num_simulations=options['simulations'],
+                sampling=options['sampling'],
+                processes=options['processes'],
+                incremental=options['incremental'],
+                batch_size=max(options['batch_size'], 1),
+                seed=options['seed'],
+            )
+        except TargetYear.DoesNotExist:
+            raise CommandError("Target year doesn't exist")
+
+        self.stdout.write(self.style.SUCCESS(
+            f'{computed} variable(s) computed, {up_to_date} up to date ({time.perf_counter() - started:.2f}s)'
+        ))
+        if failed:
+            self.stdout.write(self.style.WARNING(f'{failed} variable(s) could not be calculated'))
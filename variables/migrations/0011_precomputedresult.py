@@ -0,0 +1,32 @@
+# Generated by Django 4.2.13 on 2026-10-18 18:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('variables', '0010_rename_base_exp_variable_exp_coeff_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PrecomputedResult',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('variable_name', models.CharField(max_length=255)),
+                ('target_year', models.IntegerField()),
+                ('num_simulations', models.IntegerField()),
+                ('sampling', models.CharField(max_length=20)),
+                ('subgraph_hash', models.CharField(max_length=64)),
+                ('title', models.JSONField()),
+                ('mean', models.JSONField()),
+                ('std', models.JSONField()),
+                ('bands', models.JSONField()),
+                ('computed_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'unique_together': {('variable_name', 'target_year')},
+            },
+        ),
+    ]
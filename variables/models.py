@@ -71,4 +71,27 @@ class YearlyInputValue(models.Model):
         unique_together = ('variable', 'year')
 
     def __str__(self):
-        return f"{self.year} - {self.variable.variable_name}: {self.value}"
\ No newline at end of file
+        return f"{self.year} - {self.variable.variable_name}: {self.value}"
+
+
+# Per-year simulation results of a calculated variable (averaged over the rows sharing its
+# name), written by `manage.py precompute_results`. A row is only used while its
+# subgraph_hash matches the model's (see EvaluationPlan.subgraph_hash) for the same target
+# year, number of simulations and sampling; otherwise the variable is simulated live.
+class PrecomputedResult(models.Model):
+    variable_name = models.CharField(max_length=255)
+    target_year = models.IntegerField()
+    num_simulations = models.IntegerField()
+    sampling = models.CharField(max_length=20)
+    subgraph_hash = models.CharField(max_length=64)
+    title = models.JSONField()
+    mean = models.JSONField()
+    std = models.JSONField()
+    bands = models.JSONField()
+    computed_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('variable_name', 'target_year')
+
+    def __str__(self):
+        return f"{self.variable_name} ({self.target_year})"
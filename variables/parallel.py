@@ -0,0 +1,69 @@
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+import numpy as np
+from django.conf import settings
+
+from .engine import simulate_statistics_many
+from .statistics import SimulationStatistics
+
+process_pool = None
+process_pool_size = 0
+process_pool_lock = threading.Lock()
+
+
+# Worker processes are spawned (not forked, the web worker may be running threads)
+# and set Django up before they unpickle the plan.
+def get_process_pool(processes):
+    global process_pool, process_pool_size
+    with process_pool_lock:
+        if process_pool is None or process_pool_size != processes:
+            if process_pool is not None:
+                process_pool.shutdown(wait=False)
+            process_pool = ProcessPoolExecutor(
+                max_workers=processes,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=django.setup,
+            )
+            process_pool_size = processes
+        return process_pool
+
+# Runs in a worker process: one chunk of simulations of every variable, evaluated in one
+# pass (see engine.simulate_statistics_many) and reduced to their moments and quantile sketches
+def simulate_chunk(plan, variable_names, target_year, num_simulations, seed_sequence, sampling='random', chunk_size=1024):
+    return simulate_statistics_many(
+        plan, variable_names, target_year, num_simulations, np.random.default_rng(seed_sequence), sampling, chunk_size
+    )
+
+# Splits the simulations into `processes` chunks, each simulating all the variables
+# together, and runs them on the process pool at once. Every chunk gets its own
+# stream spawned from SeedSequence(seed), so a given (seed, processes) is reproducible,
+# and the chunk moments are merged exactly (the quantile sketches approximately).
+# Returns variable name -> SimulationStatistics, or None when the variable can't be calculated.
+def parallel_statistics(plan, variable_names, target_year, num_simulations, seed=None, processes=2, sampling='random'):
+    # Raises DependencyCycleError here rather than inside a worker
+    for variable_name in variable_names:
+        plan.order(plan.rows_named(variable_name))
+
+    chunk_sizes = [len(chunk) for chunk in np.array_split(np.arange(num_simulations), processes) if len(chunk)]
+    pool = get_process_pool(processes)
+
+    chunk_sequences = np.random.SeedSequence(seed).spawn(len(chunk_sizes))
+    futures = [
+        pool.submit(
+            simulate_chunk, plan, variable_names, target_year, chunk_size, chunk_sequence, sampling,
+            settings.SIMULATION_CHUNK_SIZE,
+        )
+        for chunk_size, chunk_sequence in zip(chunk_sizes, chunk_sequences)
+    ]
+
+    statistics = {variable_name: SimulationStatistics() for variable_name in variable_names}
+    for future in futures:
+        for variable_name, chunk in future.result().items():
+            if chunk is None or statistics[variable_name] is None:
+                statistics[variable_name] = None
+            else:
+                statistics[variable_name].merge(chunk)
+    return statistics
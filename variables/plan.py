@@ -0,0 +1,222 @@
+import copy
+import hashlib
+from collections import defaultdict
+
+import numpy as np
+
+from .models import Variable, YearlyInputValue
+
+# Part of the plan's cache key, bumped whenever EvaluationPlan's attributes change
+PLAN_FORMAT = 3
+
+COEFFICIENT_FIELDS = (
+    'linear_coeff', 'quadratic_coeff', 'cubic_coeff', 'log_coeff',
+    'exp_coeff', 'exp_rate_coeff', 'standard_deviation',
+)
+
+# Fields a what-if scenario may override on a variable, see EvaluationPlan.with_overrides
+OVERRIDABLE_FIELDS = ('level_in_2023',) + COEFFICIENT_FIELDS
+
+
+class DependencyCycleError(Exception):
+    def __init__(self, variable_names):
+        self.variable_names = sorted(variable_names)
+        super().__init__(f"Dependency cycle between: {', '.join(self.variable_names)}")
+
+
+# Compiled form of the whole Variable graph and its yearly input values.
+#
+# A row depends on every row named like its determining value (this is how
+# calc_yearly_values resolves determining_value), so variables that share an
+# upstream row point at the same node and it is evaluated only once per run.
+class EvaluationPlan:
+    def __init__(self, variables):
+        self.variables = {variable.id: variable for variable in variables}
+        # Input row id -> (year, value) points ordered by year, and target year -> the
+        # inputs interpolated by engine.input_series
+        self.input_points = defaultdict(list)
+        self.interpolated_inputs = {}
+        self.rows_by_name = defaultdict(list)
+        for variable in variables:
+            self.rows_by_name[variable.variable_name].append(variable.id)
+
+        # row id -> ids of the rows it is calculated from, None when it can't be calculated
+        self.dependencies = {}
+        for variable in variables:
+            if variable.variable_type == Variable.INPUT:
+                self.dependencies[variable.id] = []
+            elif variable.determining_value_id in self.variables:
+                determining_name = self.variables[variable.determining_value_id].variable_name
+                self.dependencies[variable.id] = list(self.rows_by_name[determining_name])
+            else:
+                self.dependencies[variable.id] = None
+
+        # Calculated rows driven by the same determining rows, split by whether they have
+        # noise, are siblings: they share one rate series and are evaluated in one kernel
+        self.siblings = {}
+        groups = defaultdict(list)
+        for variable in variables:
+            if variable.variable_type != Variable.INPUT and self.dependencies[variable.id] is not None:
+                groups[tuple(self.dependencies[variable.id]), bool(variable.standard_deviation)].append(variable.id)
+        for group in groups.values():
+            for row_id in group:
+                self.siblings[row_id] = group
+
+        # Coefficients of every row packed into arrays (structure of arrays), one entry per
+        # row in row_index order. Unset coefficients are 0, and the exponential term only
+        # counts when both of its coefficients are set.
+        self.row_index = {variable.id: index for index, variable in enumerate(variables)}
+        self.coefficients = {
+            field: np.array([getattr(variable, field) or 0 for variable in variables], dtype=float)
+            for field in COEFFICIENT_FIELDS
+        }
+        self.coefficients['exp_coeff'][self.coefficients['exp_rate_coeff'] == 0] = 0
+        self.coefficients['level_in_2023'] = np.array(
+            [np.nan if variable.level_in_2023 is None else variable.level_in_2023 for variable in variables], dtype=float
+        )
+
+        # See fingerprints()
+        self.row_fingerprints = None
+        self.row_stochastic = None
+
+    def rows_named(self, variable_name):
+        return list(self.rows_by_name.get(variable_name, []))
+
+    # Ids of the given rows and of every row upstream of them. Rows in `boundary` are
+    # included but not expanded, their series being known already.
+    def closure(self, row_ids, boundary=()):
+        seen = set()
+        stack = list(row_ids)
+        while stack:
+            row_id = stack.pop()
+            if row_id in seen:
+                continue
+            seen.add(row_id)
+            if row_id not in boundary:
+                stack.extend(self.dependencies[row_id] or [])
+        return seen
+
+    # Whether any row in the closure of row_ids has noise; if none does,
+    # every simulation of row_ids gives the same series
+    def is_stochastic(self, row_ids):
+        return any(self.variables[row_id].standard_deviation for row_id in self.closure(row_ids))
+
+    # Kahn's algorithm over `rows`, upstream rows first. Returns the ordered rows and the
+    # number of unordered dependencies left per row (nonzero for rows in or after a cycle).
+    def topological_order(self, rows, boundary=()):
+        dependencies = {row_id: [] if row_id in boundary else self.dependencies[row_id] or [] for row_id in rows}
+        pending = {row_id: len(dependencies[row_id]) for row_id in rows}
+        downstream = defaultdict(list)
+        for row_id in rows:
+            for dependency in dependencies[row_id]:
+                downstream[dependency].append(row_id)
+
+        ready = sorted(row_id for row_id, count in pending.items() if count == 0)
+        ordered = []
+        while ready:
+            row_id = ready.pop()
+            ordered.append(row_id)
+            for dependent in downstream[row_id]:
+                pending[dependent] -= 1
+                if pending[dependent] == 0:
+                    ready.append(dependent)
+        return ordered, pending
+
+    # Topological order of the closure of row_ids, upstream rows first
+    def order(self, row_ids, boundary=()):
+        rows = self.closure(row_ids, boundary)
+        ordered, pending = self.topological_order(rows, boundary)
+        if len(ordered) != len(rows):
+            cyclic = {self.variables[row_id].variable_name for row_id, count in pending.items() if count > 0}
+            raise DependencyCycleError(cyclic)
+        return ordered
+
+    # Merkle fingerprint of every row: a hash of its own fields and input points and of
+    # the fingerprints of the rows it depends on. Editing a row or one of its input values
+    # changes the fingerprint of that row and of every row downstream of it, and of no
+    # other, so anything keyed by fingerprint is dirty exactly when it has to be recomputed.
+    # Also tells whether each row has noise upstream. Rows in or after a cycle get None.
+    # Returns (row id -> fingerprint, row id -> stochastic).
+    def fingerprints(self):
+        if self.row_fingerprints is None:
+            self.row_fingerprints = dict.fromkeys(self.variables)
+            self.row_stochastic = {}
+            ordered, _ = self.topological_order(self.variables)
+            for row_id in ordered:
+                variable = self.variables[row_id]
+                dependencies = self.dependencies[row_id] or []
+                self.row_fingerprints[row_id] = hashlib.sha256(repr((
+                    variable.variable_name, variable.variable_type, variable.level_in_2023,
+                    [getattr(variable, field) for field in COEFFICIENT_FIELDS],
+                    self.input_points.get(row_id, []),
+                    self.dependencies[row_id] is None,
+                    [self.row_fingerprints[dependency] for dependency in dependencies],
+                )).encode()).hexdigest()
+                self.row_stochastic[row_id] = bool(variable.standard_deviation) or any(
+                    self.row_stochastic[dependency] for dependency in dependencies
+                )
+        return self.row_fingerprints, self.row_stochastic
+
+    # Whether the rows named variable_name can be calculated: rows in or after a dependency
+    # cycle have no fingerprint, and are left out so that they don't stop a shared pass.
+    def calculable(self, variable_name):
+        fingerprints, _ = self.fingerprints()
+        return all(fingerprints[row_id] is not None for row_id in self.rows_named(variable_name))
+
+    # Fingerprint of everything the closure of row_ids is calculated from. It only
+    # changes when a row upstream of row_ids (or one of their input values) changes.
+    def subgraph_hash(self, row_ids):
+        fingerprints, _ = self.fingerprints()
+        return hashlib.sha256(repr([(row_id, fingerprints[row_id]) for row_id in sorted(row_ids)]).encode()).hexdigest()
+
+    # An in-memory copy of the plan with some input points and coefficients replaced, for
+    # what-if scenarios that must not touch the database. inputs: row id -> {year: value}
+    # (a None value removes that year's point), coefficients: row id -> {field: value}.
+    # Only the overridden rows are copied, and only their fingerprints and those of the rows
+    # downstream change, so everything else is served from what the baseline has cached.
+    # Raises ValueError for overrides that don't fit the model.
+    def with_overrides(self, inputs=None, coefficients=None):
+        variables = dict(self.variables)
+        for row_id, fields in (coefficients or {}).items():
+            if row_id not in variables:
+                raise ValueError(f"Variable {row_id} doesn't exist")
+            if not isinstance(fields, dict):
+                raise ValueError(f'The coefficients of variable {row_id} must be an object of field -> value')
+            variable = copy.copy(variables[row_id])
+            for field, value in fields.items():
+                if field not in OVERRIDABLE_FIELDS:
+                    raise ValueError(f"{field} can't be overridden, use one of {', '.join(OVERRIDABLE_FIELDS)}")
+                setattr(variable, field, None if value is None else float(value))
+            variables[row_id] = variable
+
+        plan = EvaluationPlan(list(variables.values()))
+        for row_id, points in self.input_points.items():
+            plan.input_points[row_id] = list(points)
+        for row_id, points in (inputs or {}).items():
+            if row_id not in variables or variables[row_id].variable_type != Variable.INPUT:
+                raise ValueError(f'Variable {row_id} is not an input')
+            if not isinstance(points, dict):
+                raise ValueError(f'The values of input {row_id} must be an object of year -> value')
+            merged = dict(plan.input_points.get(row_id, []))
+            for year, value in points.items():
+                if int(year) <= 2023:
+                    raise ValueError('Input values can only be overridden after 2023')
+                if value is None:
+                    merged.pop(int(year), None)
+                else:
+                    merged[int(year)] = float(value)
+            plan.input_points[row_id] = sorted(merged.items())
+        return plan
+
+    # Packed coefficients of row_ids, in that order
+    def packed_coefficients(self, row_ids):
+        indexes = [self.row_index[row_id] for row_id in row_ids]
+        return {field: values[indexes] for field, values in self.coefficients.items()}
+
+
+# Two queries: one for the Variable graph and one for all the yearly input values that are set
+def compile_plan():
+    plan = EvaluationPlan(list(Variable.objects.select_related('determining_value')))
+    for variable_id, year, value in YearlyInputValue.objects.exclude(value=None).order_by('year').values_list('variable_id', 'year', 'value'):
+        plan.input_points[variable_id].append((year, value))
+    return plan
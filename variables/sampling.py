@@ -0,0 +1,69 @@
+import warnings
+
+import numpy as np
+from scipy.special import ndtri
+from scipy.stats import qmc
+
+# Ways of drawing the standard normal noise of engine.formula_kernel:
+#   random      independent draws
+#   antithetic  the second half of the simulations mirrors the first (z and -z)
+#   lhs         Latin hypercube over every (variable, year) noise term
+#   sobol       scrambled Sobol' quasi-random points (best with a power-of-two number of simulations)
+SAMPLING_METHODS = ('random', 'antithetic', 'lhs', 'sobol')
+
+# scipy's Sobol' engine supports at most this many dimensions
+SOBOL_MAX_DIMENSIONS = 21201
+
+
+# Every noise term gets its own stream, seeded from one draw of `rng` and the term's key.
+# Two runs started from the same seed therefore see the same noise for every (variable,
+# determining row) and year (common random numbers), whichever other variables they
+# evaluate, so their difference isn't buried in Monte Carlo noise. Each call still
+# consumes `rng`, so successive chunks differ.
+#
+# The space-filling methods are drawn per noise term too, only when the term is needed, so
+# memory stays at one (num_simulations x years) block whatever the number of terms. A Latin
+# hypercube stratifies each dimension on its own, so per-term hypercubes are one over all
+# the terms. Sobol' points are space-filling across the years of a term, and each term's
+# points are shuffled independently (Latin supercube sampling, Owen 1998).
+#
+# random and antithetic draw year-major, so a run to an earlier target year sees the first
+# years of a later one's noise. Latin hypercube and Sobol' points depend on their number of
+# dimensions instead: runs with different target years only share their noise when both
+# are drawn over the same `years` (at least), as engine.paired_statistics does.
+class NoiseSampler:
+    def __init__(self, method, rng, num_simulations, years=0):
+        if method not in SAMPLING_METHODS:
+            raise ValueError(f'Unknown sampling method: {method}')
+        self.method = method
+        self.entropy = int(rng.integers(2 ** 63))
+        self.num_simulations = num_simulations
+        self.years = years
+
+    def stream(self, key=()):
+        return np.random.default_rng(np.random.SeedSequence(self.entropy, spawn_key=key))
+
+    # (num_simulations x years) standard normals for one noise term
+    def normal(self, key, years):
+        stream = self.stream(key)
+        if self.method == 'antithetic':
+            half = stream.standard_normal((years, (self.num_simulations + 1) // 2)).T
+            return np.concatenate([half, -half])[:self.num_simulations]
+        if self.method == 'random':
+            return stream.standard_normal((years, self.num_simulations)).T
+
+        dimensions = max(years, self.years)
+        if self.method == 'lhs':
+            uniform = qmc.LatinHypercube(d=dimensions, seed=stream).random(self.num_simulations)
+        else:
+            if dimensions > SOBOL_MAX_DIMENSIONS:
+                raise ValueError(f'Sobol sampling supports {SOBOL_MAX_DIMENSIONS} years, this run needs {dimensions}')
+            with warnings.catch_warnings():
+                # Balance is only guaranteed for powers of two, other counts still beat random draws
+                warnings.simplefilter('ignore', UserWarning)
+                uniform = qmc.Sobol(d=dimensions, scramble=True, seed=stream).random(self.num_simulations)
+            uniform = uniform[stream.permutation(self.num_simulations)]
+        uniform = uniform[:, :years]
+        epsilon = np.finfo(float).eps
+        # The inverse normal CDF, norm.ppf without its argument checking
+        return ndtri(np.clip(uniform, epsilon, 1 - epsilon))
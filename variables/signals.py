@@ -0,0 +1,15 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .caching import bump_model_revision
+from .models import Variable, TargetYear, YearlyInputValue
+
+
+# The revision is bumped once the transaction commits; bumping earlier would let
+# another worker cache the pre-commit rows under the new revision.
+@receiver([post_save, post_delete], sender=Variable)
+@receiver([post_save, post_delete], sender=YearlyInputValue)
+@receiver([post_save, post_delete], sender=TargetYear)
+def invalidate_model_cache(sender, **kwargs):
+    transaction.on_commit(bump_model_revision)
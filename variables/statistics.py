@@ -0,0 +1,142 @@
+import numpy as np
+
+
+# Per-year mean and variance of simulated trajectories, accumulated chunk by chunk.
+# Chunks are merged with Chan et al.'s parallel form of Welford's algorithm, so the
+# result equals np.mean / np.std over all trajectories without keeping them around,
+# and two accumulators (e.g. from different processes) can be merged exactly.
+class MomentAccumulator:
+    def __init__(self):
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+
+    # values: (simulations x years) array
+    def add(self, values):
+        values = np.asarray(values, dtype=float)
+        if values.shape[0] == 0:
+            return
+        batch_mean = values.mean(axis=0)
+        batch_m2 = ((values - batch_mean) ** 2).sum(axis=0)
+        self.combine(values.shape[0], batch_mean, batch_m2)
+
+    def merge(self, other):
+        if other.count:
+            self.combine(other.count, other.mean, other.m2)
+
+    def combine(self, count, mean, m2):
+        if self.count == 0:
+            self.count, self.mean, self.m2 = count, np.array(mean, dtype=float), np.array(m2, dtype=float)
+            return
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean = self.mean + delta * count / total
+        self.m2 = self.m2 + m2 + delta ** 2 * self.count * count / total
+        self.count = total
+
+    # Population standard deviation, like np.std
+    @property
+    def std(self):
+        return np.sqrt(self.m2 / self.count)
+
+    # Standard errors of the per-year mean and std (the latter assuming roughly normal values)
+    def standard_errors(self):
+        std = self.std
+        return std / np.sqrt(self.count), std / np.sqrt(2 * max(self.count - 1, 1))
+
+    # Whether both standard errors are within `tolerance` of the mean's magnitude in every year
+    def converged(self, tolerance):
+        if self.count < 2:
+            return False
+        mean_error, std_error = self.standard_errors()
+        scale = np.maximum(np.abs(self.mean), np.finfo(float).tiny)
+        return bool(np.all(mean_error <= tolerance * scale) and np.all(std_error <= tolerance * scale))
+
+
+# Percentiles drawn as bands around the mean, next to +-1 std dev
+BAND_PERCENTILES = (5, 50, 95)
+
+
+# Bounded-memory, mergeable per-year quantile sketch (a KLL-style compactor hierarchy).
+# Level i holds rows of simulated values standing for 2**i simulations each; when a
+# level grows past `capacity` rows, every year's column is sorted and every other
+# value is promoted to the next level. Memory stays around 2 * capacity * log2(n / capacity)
+# values per year whatever the number of simulations n, and up to `capacity` simulations
+# the quantiles are exact. The rank error is roughly log2(n / capacity) / capacity.
+class QuantileSketch:
+    def __init__(self, capacity=256):
+        self.capacity = capacity
+        self.levels = []
+        self.offsets = []
+
+    # values: (simulations x years) array
+    def add(self, values):
+        values = np.asarray(values, dtype=float)
+        if values.shape[0] == 0:
+            return
+        self.extend(0, values)
+        self.compact()
+
+    def merge(self, other):
+        for level, values in enumerate(other.levels):
+            self.extend(level, values)
+        self.compact()
+
+    def extend(self, level, values):
+        while len(self.levels) <= level:
+            self.levels.append(None)
+            self.offsets.append(0)
+        if self.levels[level] is None:
+            self.levels[level] = values
+        else:
+            self.levels[level] = np.concatenate([self.levels[level], values])
+
+    def compact(self):
+        level = 0
+        while level < len(self.levels):
+            values = self.levels[level]
+            if values is not None and values.shape[0] > self.capacity:
+                values = np.sort(values, axis=0)
+                # An odd row out stays behind, and alternating which half is promoted
+                # keeps the compactions from biasing the ranks in one direction
+                kept = values.shape[0] % 2
+                self.levels[level] = values[:kept] if kept else None
+                self.extend(level + 1, values[kept + self.offsets[level]::2])
+                self.offsets[level] ^= 1
+            level += 1
+
+    # Weighted per-year quantiles, q in [0, 1]. Returns a (len(qs) x years) array.
+    def quantiles(self, qs):
+        rows = [(values, 2 ** level) for level, values in enumerate(self.levels) if values is not None]
+        values = np.concatenate([values for values, _ in rows])
+        weights = np.concatenate([np.full(values.shape[0], weight) for values, weight in rows])
+
+        order = np.argsort(values, axis=0)
+        sorted_values = np.take_along_axis(values, order, axis=0)
+        cumulative = np.cumsum(weights[order], axis=0)
+        total = cumulative[-1]
+        result = []
+        for q in qs:
+            # First value whose cumulative weight reaches q of the total, per year
+            index = np.minimum((cumulative < q * total).sum(axis=0), values.shape[0] - 1)
+            result.append(np.take_along_axis(sorted_values, index[np.newaxis, :], axis=0)[0])
+        return np.array(result)
+
+
+# Moments plus a quantile sketch, for when the bands need percentiles too
+class SimulationStatistics(MomentAccumulator):
+    def __init__(self, capacity=256):
+        super().__init__()
+        self.sketch = QuantileSketch(capacity)
+
+    def add(self, values):
+        super().add(values)
+        self.sketch.add(values)
+
+    def merge(self, other):
+        super().merge(other)
+        self.sketch.merge(other.sketch)
+
+    # {percentile: per-year values} for BAND_PERCENTILES
+    def bands(self):
+        return dict(zip(BAND_PERCENTILES, self.sketch.quantiles([percentile / 100 for percentile in BAND_PERCENTILES])))
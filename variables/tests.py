@@ -1,3 +1,500 @@
-from django.test import TestCase
+import json
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from django.core.cache import cache, caches
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from scipy.interpolate import PchipInterpolator
+from scipy.special import ndtr
+
+from .caching import model_revision, result_cache, series_cache
+from .engine import formula_kernel, input_series, paired_statistics, simulate_statistics_many
+from .functions import compare_engines, formula, get_evaluation_plan, graph_series, run_simulations, run_simulations_many
+from .models import Variable, TargetYear, YearlyInputValue
+from .plan import DependencyCycleError, compile_plan
+from .sampling import SAMPLING_METHODS, NoiseSampler
+from .statistics import MomentAccumulator, SimulationStatistics
+
+TARGET_YEAR = 2060
+
+
+def create_input(name, level, points=()):
+    variable = Variable.objects.create(variable_name=name, variable_type=Variable.INPUT, level_in_2023=level)
+    YearlyInputValue.objects.bulk_create([YearlyInputValue(variable=variable, year=year, value=value) for year, value in points])
+    return variable
+
+def create_calculated(name, determining_value, level=10, **coefficients):
+    return Variable.objects.create(
+        variable_name=name, variable_type=Variable.CALCULATED, level_in_2023=level,
+        determining_value=determining_value, **coefficients,
+    )
+
+
+# A small model: two inputs, a stochastic variable, a variable with two rows (one
+# stochastic), one downstream of it and a deterministic one. Every test starts with
+# empty caches, and the engine runs in-process with independent draws.
+@override_settings(SIMULATION_PROCESSES=1, SIMULATION_SAMPLING='random', SIMULATION_TOLERANCE=0)
+class ModelTestCase(TestCase):
+    def setUp(self):
+        TargetYear.objects.create(year=TARGET_YEAR)
+        self.population = create_input('Population', 100, [(2030, 120), (2045, 140), (2060, 150)])
+        self.gdp = create_input('GDP', 50, [(2030, 60), (2040, 55), (2060, 80)])
+        self.food = create_calculated('Food', self.population, linear_coeff=0.8, standard_deviation=2)
+        self.energy = create_calculated('Energy', self.population, linear_coeff=0.5, quadratic_coeff=0.1)
+        self.energy_from_gdp = create_calculated('Energy', self.gdp, linear_coeff=0.7, standard_deviation=1)
+        self.emissions = create_calculated('Emissions', self.energy, linear_coeff=1.0, log_coeff=0.2)
+        self.water = create_calculated('Water', self.gdp, linear_coeff=0.6, cubic_coeff=0.05)
+
+        cache.clear()
+        caches['results'].clear()
+        result_cache.local.clear()
+        series_cache.clear()
+
+    def create_cycle(self):
+        first = create_calculated('A', None, linear_coeff=1, standard_deviation=1)
+        second = create_calculated('B', first, linear_coeff=1)
+        first.determining_value = second
+        first.save()
+        return first, second
+
+
+class EvaluationPlanTests(ModelTestCase):
+    def test_order_puts_every_row_after_its_dependencies(self):
+        plan = compile_plan()
+        order = plan.order(plan.rows_named('Emissions'))
+
+        self.assertEqual(set(order), {self.population.id, self.gdp.id, self.energy.id, self.energy_from_gdp.id, self.emissions.id})
+        for row_id in order:
+            for dependency in plan.dependencies[row_id] or []:
+                self.assertLess(order.index(dependency), order.index(row_id))
+
+    def test_a_row_depends_on_every_row_named_like_its_determining_value(self):
+        plan = compile_plan()
+
+        self.assertEqual(sorted(plan.dependencies[self.emissions.id]), sorted([self.energy.id, self.energy_from_gdp.id]))
+
+    def test_cycle_is_detected(self):
+        first, second = self.create_cycle()
+        downstream = create_calculated('C', second, linear_coeff=1)
+        plan = compile_plan()
+
+        with self.assertRaises(DependencyCycleError) as raised:
+            plan.order([downstream.id])
+        self.assertEqual(raised.exception.variable_names, ['A', 'B', 'C'])
+
+    def test_rows_in_or_after_a_cycle_have_no_fingerprint(self):
+        first, second = self.create_cycle()
+        downstream = create_calculated('C', second, linear_coeff=1)
+        plan = compile_plan()
+
+        fingerprints, _ = plan.fingerprints()
+        self.assertIsNone(fingerprints[first.id])
+        self.assertIsNone(fingerprints[downstream.id])
+        self.assertIsNotNone(fingerprints[self.food.id])
+
+    def test_variables_in_or_after_a_cycle_are_not_calculable(self):
+        _, second = self.create_cycle()
+        create_calculated('C', second, linear_coeff=1)
+        plan = compile_plan()
+
+        self.assertEqual([name for name in ('A', 'B', 'C', 'Food', 'Emissions') if plan.calculable(name)], ['Food', 'Emissions'])
+
+
+class CacheRevisionTests(ModelTestCase):
+    def test_saving_a_variable_bumps_the_revision(self):
+        revision = model_revision()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.food.linear_coeff = 0.9
+            self.food.save()
+
+        self.assertNotEqual(model_revision(), revision)
+
+    def test_cached_plan_is_reloaded_after_an_edit(self):
+        self.assertEqual(get_evaluation_plan().variables[self.food.id].linear_coeff, 0.8)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.food.linear_coeff = 0.9
+            self.food.save()
+
+        self.assertEqual(get_evaluation_plan().variables[self.food.id].linear_coeff, 0.9)
+
+    def test_input_page_bulk_update_bumps_the_revision(self):
+        url = f"{reverse('input_yearly_values')}?year=2030"
+        self.client.get(url)
+        values = list(YearlyInputValue.objects.filter(year=2030).order_by('id'))
+        data = {'form-TOTAL_FORMS': len(values), 'form-INITIAL_FORMS': len(values)}
+        for index, value in enumerate(values):
+            data[f'form-{index}-id'] = value.id
+            data[f'form-{index}-value'] = 200 if value.variable_id == self.population.id else value.value
+
+        revision = model_revision()
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(url, data)
+
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(YearlyInputValue.objects.get(variable=self.population, year=2030).value, 200)
+        self.assertNotEqual(model_revision(), revision)
+
+    def test_input_page_query_count_does_not_grow_with_the_inputs(self):
+        url = f"{reverse('input_yearly_values')}?year=2030"
+
+        def count_queries():
+            cache.clear()
+            self.client.get(url)
+            with CaptureQueriesContext(connection) as queries:
+                self.assertEqual(self.client.get(url).status_code, 200)
+            return len(queries)
+
+        few = count_queries()
+        for index in range(10):
+            create_input(f'Input {index}', 10 + index, [(2030, 20 + index)])
+        self.assertEqual(count_queries(), few)
+
+
+class ResultKeyTests(ModelTestCase):
+    def test_unrelated_edit_keeps_the_subgraph_hash(self):
+        plan = compile_plan()
+        food = plan.subgraph_hash(plan.rows_named('Food'))
+        water = plan.subgraph_hash(plan.rows_named('Water'))
+
+        YearlyInputValue.objects.create(variable=self.gdp, year=2050, value=90)
+        edited = compile_plan()
+
+        self.assertEqual(edited.subgraph_hash(edited.rows_named('Food')), food)
+        self.assertNotEqual(edited.subgraph_hash(edited.rows_named('Water')), water)
+
+    def test_edit_changes_the_fingerprints_downstream_only(self):
+        plan = compile_plan()
+        self.energy.linear_coeff = 0.6
+        self.energy.save()
+        edited = compile_plan()
+        fingerprints, _ = plan.fingerprints()
+        edited_fingerprints, _ = edited.fingerprints()
+
+        changed = {row_id for row_id in fingerprints if fingerprints[row_id] != edited_fingerprints[row_id]}
+        self.assertEqual(changed, {self.energy.id, self.emissions.id})
+
+    def test_result_is_served_from_the_cache_after_an_unrelated_edit(self):
+        first = run_simulations(self.food.id, TARGET_YEAR, 50, seed=1)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.water.linear_coeff = 0.65
+            self.water.save()
+
+        with mock.patch('variables.engine.evaluate_plan') as evaluate_plan:
+            second = run_simulations(self.food.id, TARGET_YEAR, 50, seed=1)
+        evaluate_plan.assert_not_called()
+        np.testing.assert_array_equal(first[0], second[0])
+
+    def test_upstream_edit_recomputes_the_result(self):
+        first = run_simulations(self.water.id, TARGET_YEAR)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.water.linear_coeff = 0.65
+            self.water.save()
+
+        second = run_simulations(self.water.id, TARGET_YEAR)
+        self.assertFalse(np.array_equal(first[0], second[0]))
+
+
+class StatisticsTests(TestCase):
+    def test_merged_chunks_match_numpy(self):
+        values = np.random.default_rng(0).lognormal(size=(1000, 12)) * 1e6
+        accumulator, other = MomentAccumulator(), MomentAccumulator()
+        for chunk in np.array_split(values[:700], 7):
+            accumulator.add(chunk)
+        other.add(values[700:])
+        accumulator.merge(other)
+
+        self.assertEqual(accumulator.count, 1000)
+        np.testing.assert_allclose(accumulator.mean, values.mean(axis=0), rtol=1e-12)
+        np.testing.assert_allclose(accumulator.std, values.std(axis=0), rtol=1e-10)
+
+    def test_bands_are_exact_up_to_the_sketch_capacity(self):
+        values = np.random.default_rng(0).normal(size=(200, 5))
+        statistics = SimulationStatistics(capacity=256)
+        for chunk in np.array_split(values, 4):
+            statistics.add(chunk)
+
+        for percentile, band in statistics.bands().items():
+            np.testing.assert_array_equal(band, np.percentile(values, percentile, axis=0, method='inverted_cdf'))
+
+    def test_bands_stay_close_beyond_the_sketch_capacity(self):
+        values = np.random.default_rng(0).normal(size=(20000, 3))
+        statistics = SimulationStatistics(capacity=256)
+        for chunk in np.array_split(values, 20):
+            statistics.add(chunk)
+
+        for percentile, band in statistics.bands().items():
+            ranks = (values < band).mean(axis=0)
+            np.testing.assert_allclose(ranks, percentile / 100, atol=0.03)
+
+
+class FormulaKernelTests(ModelTestCase):
+    def test_kernel_matches_formula_on_deterministic_rows(self):
+        siblings = [
+            create_calculated('Sibling', self.gdp, level=5, linear_coeff=0.7),
+            create_calculated('Sibling', self.gdp, level=8, linear_coeff=0.4, quadratic_coeff=0.2, cubic_coeff=0.1),
+            create_calculated('Sibling', self.gdp, level=3, log_coeff=0.3, exp_coeff=0.1, exp_rate_coeff=0.5),
+            create_calculated('Sibling', self.gdp, level=2, linear_coeff=-3),
+        ]
+        plan = compile_plan()
+        determining = np.array([50.0, 60.0, 55.0, 55.0, 80.0, 120.0, 100.0, 95.0])
+
+        results = formula_kernel(plan.packed_coefficients([variable.id for variable in siblings]), determining[np.newaxis, :])
+
+        for variable, result in zip(siblings, results):
+            np.testing.assert_allclose(result[0], formula(variable, determining.tolist()), rtol=1e-12)
+
+    def test_deterministic_engines_agree(self):
+        comparison = compare_engines(self.water.id, TARGET_YEAR, 20, seed=0)
+
+        self.assertEqual(comparison['max_mean_z'], 0)
+        self.assertEqual(comparison['max_std_z'], 0)
+        self.assertLess(comparison['max_deterministic_relative_error'], 1e-9)
+
+
+class InputSeriesTests(ModelTestCase):
+    def test_batched_interpolation_matches_one_interpolator_per_input(self):
+        shared = create_input('Shared knots', 100, [(2030, 200), (2045, 50), (2060, 150)])
+        flat = create_input('Flat', 7)
+        plan = compile_plan()
+        rows, matrix = input_series(plan, TARGET_YEAR)
+        years = np.arange(2023, TARGET_YEAR + 1)
+
+        for variable in (self.population, self.gdp, shared):
+            points = [(2023, variable.level_in_2023)] + [
+                (value.year, value.value) for value in variable.yearly_input_values.order_by('year')
+            ]
+            expected = PchipInterpolator([year for year, _ in points], [value for _, value in points])(years)
+            np.testing.assert_allclose(matrix[rows[variable.id]], expected, rtol=1e-12)
+        np.testing.assert_array_equal(matrix[rows[flat.id]], np.full(len(years), 7.0))
+
+
+class SamplingTests(ModelTestCase):
+    def test_every_method_estimates_the_same_distribution(self):
+        reference_mean, reference_std = run_simulations(self.food.id, TARGET_YEAR, 4000, seed=0, sampling='random')[:2]
+
+        for sampling in SAMPLING_METHODS:
+            mean, std = run_simulations(self.food.id, TARGET_YEAR, 256, seed=1, sampling=sampling)[:2]
+            np.testing.assert_allclose(mean, reference_mean, rtol=0.02, err_msg=sampling)
+            np.testing.assert_allclose(std[1:], reference_std[1:], rtol=0.2, err_msg=sampling)
+
+    def test_results_do_not_depend_on_the_other_variables_simulated(self):
+        plan = compile_plan()
+        for sampling in SAMPLING_METHODS:
+            alone = simulate_statistics_many(plan, ['Food'], TARGET_YEAR, 64, np.random.default_rng(1), sampling)['Food']
+            together = simulate_statistics_many(plan, ['Food', 'Emissions'], TARGET_YEAR, 64, np.random.default_rng(1), sampling)['Food']
+            np.testing.assert_array_equal(alone.mean, together.mean)
+            np.testing.assert_array_equal(alone.std, together.std)
+
+    def test_latin_hypercube_stratifies_every_year(self):
+        normals = NoiseSampler('lhs', np.random.default_rng(0), 50).normal((1, 2), 10)
+        strata = np.floor(50 * ndtr(normals))
+
+        for year in range(10):
+            self.assertEqual(sorted(strata[:, year]), list(range(50)))
+
+    def test_antithetic_draws_mirror_each_other(self):
+        normals = NoiseSampler('antithetic', np.random.default_rng(0), 10).normal((1, 2), 4)
+
+        np.testing.assert_array_equal(normals[:5], -normals[5:])
+
+    def test_graph_pages_only_accept_known_sampling_and_engines(self):
+        for page in ('graph', 'dashboard'):
+            self.assertContains(self.client.get(reverse(page), {'sampling': 'lhs'}), "body.append('sampling', 'lhs');")
+            for parameters in ({'sampling': "');alert(1);//"}, {'engine': "');alert(1);//"}):
+                self.assertEqual(self.client.get(reverse(page), parameters).status_code, 400, (page, parameters))
+
+
+class SimulationTests(ModelTestCase):
+    def test_cycle_only_fails_the_variables_in_it(self):
+        first, _ = self.create_cycle()
+
+        food, cyclic = run_simulations_many([self.food.id, first.id], TARGET_YEAR, 20, seed=0)
+
+        self.assertIsNotNone(food)
+        self.assertIsNone(cyclic)
+
+    def test_simulations_spread_from_the_2023_level(self):
+        mean, std = run_simulations(self.food.id, TARGET_YEAR, 200, seed=0)[:2]
+
+        self.assertEqual(len(mean), TARGET_YEAR - 2023 + 1)
+        self.assertEqual((mean[0], std[0]), (10, 0))
+        self.assertTrue(np.all(std[1:] > 0))
+
+    def test_deterministic_variable_has_no_spread(self):
+        mean, std = run_simulations(self.water.id, TARGET_YEAR)[:2]
+
+        self.assertEqual(len(mean), TARGET_YEAR - 2023 + 1)
+        np.testing.assert_array_equal(std, 0)
+
+    def test_common_random_numbers_shrink_the_difference(self):
+        plan = compile_plan()
+        scenario = plan.with_overrides(coefficients={self.food.id: {'linear_coeff': 0.82}})
+
+        first, second, difference = paired_statistics(plan, scenario, 'Food', TARGET_YEAR, TARGET_YEAR, 200, seed=1)
+
+        independent = np.sqrt(first.std[-1] ** 2 + second.std[-1] ** 2)
+        self.assertLess(difference.std[-1], 0.1 * independent)
+        self.assertGreater(difference.mean[-1], 0)
+
+    def test_same_plan_paired_with_itself_has_no_difference(self):
+        plan = compile_plan()
+
+        _, _, difference = paired_statistics(plan, plan, 'Emissions', TARGET_YEAR, TARGET_YEAR, 50, seed=3)
+
+        np.testing.assert_array_equal(difference.mean, 0)
+        np.testing.assert_array_equal(difference.std, 0)
+
+    def test_every_sampling_shares_its_noise_across_target_years(self):
+        plan = compile_plan()
+
+        for sampling in SAMPLING_METHODS:
+            _, _, difference = paired_statistics(plan, plan, 'Food', 2040, TARGET_YEAR, 64, seed=4, sampling=sampling)
+            np.testing.assert_allclose(difference.std, 0, atol=1e-9, err_msg=sampling)
+
+
+class GraphSeriesTests(ModelTestCase):
+    def test_diverging_model_is_sent_as_null(self):
+        zero = create_input('Zero', 0, [(2030, 10)])
+        diverging = create_calculated('Diverging', zero, linear_coeff=1, standard_deviation=1)
+
+        series = graph_series([diverging.id])
+
+        variable, = json.loads(json.dumps(series, allow_nan=False))['variables']
+        self.assertIsNone(variable['mean'][-1])
+        self.assertIsNone(variable['bands']['p95'][-1])
+
+
+class StreamViewTests(ModelTestCase):
+    def events(self, response):
+        events = []
+        for block in b''.join(response.streaming_content).decode().strip().split('\n\n'):
+            lines = dict(line.split(': ', 1) for line in block.split('\n'))
+            events.append((lines.get('event', 'message'), json.loads(lines['data'])))
+        return events
+
+    def test_stream_sends_the_running_series_after_every_chunk(self):
+        response = self.client.get(reverse('stream_graph'), {'variables': [self.food.id, self.emissions.id], 'simulations': 30, 'chunk': 10})
+
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        events = self.events(response)
+        self.assertEqual([event for event, _ in events], ['message'] * 3 + ['done'])
+        self.assertEqual([data['simulations'] for _, data in events[:3]], [10, 20, 30])
+        update = events[2][1]
+        self.assertEqual([variable['name'] for variable in update['variables']], ['Food', 'Emissions'])
+        self.assertEqual(len(update['variables'][0]['mean']), len(update['years']))
+
+    @override_settings(SIMULATION_STREAM_SECONDS=0)
+    def test_stream_stops_at_the_time_limit(self):
+        response = self.client.get(reverse('stream_graph'), {'variables': [self.food.id], 'simulations': 30, 'chunk': 10})
+
+        self.assertEqual(self.events(response), [('message', mock.ANY), ('done', {'timed_out': True})])
+
+    def test_stream_reports_a_cycle_as_an_error_event(self):
+        first, _ = self.create_cycle()
+
+        events = self.events(self.client.get(reverse('stream_graph'), {'variables': [first.id]}))
+
+        self.assertEqual(events[0][0], 'error')
+        self.assertIn('A, B', events[0][1]['error'])
+
+    def test_stream_requires_variables(self):
+        self.assertEqual(self.client.get(reverse('stream_graph')).status_code, 400)
+
+
+class ExportViewTests(ModelTestCase):
+    def test_csv_has_a_row_per_variable_and_year(self):
+        response = self.client.get(reverse('export'), {'variables': [self.food.id, self.water.id], 'simulations': 20})
+
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0], 'variable_id,variable,year,mean,std,p5,p50,p95')
+        self.assertEqual(len(lines), 1 + 2 * (TARGET_YEAR - 2023 + 1))
+        self.assertTrue(lines[1].startswith(f'{self.food.id},Food,2023,'))
+        self.assertTrue(lines[-1].startswith(f'{self.water.id},Water,{TARGET_YEAR},'))
+
+    def test_ndjson_reports_the_variables_that_cannot_be_calculated(self):
+        first, _ = self.create_cycle()
+
+        response = self.client.get(reverse('export'), {'variables': [first.id, self.water.id], 'format': 'ndjson'})
+
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual(rows[0], {'variable_id': first.id, 'variable': 'A', 'error': 'could not be calculated'})
+        self.assertEqual({row['variable'] for row in rows[1:]}, {'Water'})
+        self.assertEqual(len(rows), 1 + TARGET_YEAR - 2023 + 1)
+
+    def test_export_defaults_to_every_calculated_variable(self):
+        response = self.client.get(reverse('export'), {'simulations': 10})
+
+        lines = b''.join(response.streaming_content).decode().splitlines()[1:]
+        self.assertEqual({line.split(',')[1] for line in lines}, {'Food', 'Energy', 'Emissions', 'Water'})
+
+    def test_unknown_format_is_rejected(self):
+        self.assertEqual(self.client.get(reverse('export'), {'format': 'xlsx'}).status_code, 400)
+
+
+class ScenarioViewTests(ModelTestCase):
+    def post(self, body):
+        return self.client.post(reverse('scenario'), json.dumps(body), content_type='application/json')
+
+    def test_scenario_compares_the_changed_variables_with_the_baseline(self):
+        response = self.post({
+            'variables': [self.food.id, self.water.id],
+            'coefficients': {str(self.food.id): {'linear_coeff': 0.9}},
+            'simulations': 50, 'seed': 1,
+        })
+
+        self.assertEqual(response.status_code, 200)
+        food, water = response.json()['variables']
+        self.assertTrue(food['changed'])
+        self.assertGreater(food['mean'][-1], food['baseline']['mean'][-1])
+        self.assertFalse(water['changed'])
+
+    def test_scenario_pairs_the_changed_variables_with_the_baseline(self):
+        response = self.post({
+            'variables': [self.food.id],
+            'coefficients': {str(self.food.id): {'linear_coeff': 0.9}},
+            'simulations': 50, 'seed': 1,
+        })
+
+        food, = response.json()['variables']
+        self.assertEqual(set(food['difference']), {'mean', 'std', 'p5', 'p95'})
+        self.assertGreater(food['difference']['mean'][-1], 0)
+
+    def test_scenario_does_not_touch_the_database(self):
+        self.post({'variables': [self.water.id], 'inputs': {str(self.gdp.id): {'2050': 90}}})
+
+        self.assertFalse(YearlyInputValue.objects.filter(variable=self.gdp, year=2050).exists())
+
+    def test_unchanged_variables_follow_the_seed(self):
+        def food(seed):
+            response = self.post({
+                'variables': [self.food.id],
+                'coefficients': {str(self.water.id): {'linear_coeff': 0.9}},
+                'simulations': 20, 'seed': seed,
+            })
+            variable, = response.json()['variables']
+            self.assertFalse(variable['changed'])
+            return variable['mean']
+
+        self.assertEqual(food(1), food(1))
+        self.assertNotEqual(food(1), food(2))
+
+    def test_target_year_is_capped(self):
+        response = self.post({'variables': [self.food.id], 'target_year': 200000})
+
+        self.assertEqual(response.status_code, 400)
+
+    def test_invalid_overrides_are_rejected(self):
+        for body in (
+            {'variables': [self.food.id], 'coefficients': {str(self.food.id): 5}},
+            {'variables': [self.food.id], 'inputs': {str(self.population.id): [1, 2]}},
+            {'variables': [self.food.id], 'coefficients': {str(self.food.id): {'variable_name': 'x'}}},
+            {'variables': [self.food.id], 'inputs': {str(self.food.id): {'2050': 1}}},
+            {'variables': [self.food.id], 'inputs': {str(self.population.id): {'2020': 1}}},
+        ):
+            response = self.post(body)
+            self.assertEqual(response.status_code, 400, body)
+            self.assertIn('error', response.json())
@@ -10,4 +10,10 @@ urlpatterns = [
     path('testing/', views.testing, name='testing'),
     path('output/', views.output, name='output'),
     path('output/graph', views.graph, name='graph'),
+    path('output/dashboard', views.dashboard, name='dashboard'),
+    path('output/graph/stream', views.stream_graph, name='stream_graph'),
+    path('output/graph/jobs', views.submit_graph_job, name='submit_graph_job'),
+    path('output/graph/jobs/<str:job_id>', views.graph_job_status, name='graph_job_status'),
+    path('output/export', views.export, name='export'),
+    path('output/scenario', views.scenario, name='scenario'),
 ]
\ No newline at end of file
@@ -1,16 +1,34 @@
 from django.shortcuts import render, redirect
-from django.http import HttpResponse, HttpResponseRedirect
+from django.http import HttpResponse, HttpResponseRedirect, JsonResponse, StreamingHttpResponse
 from django.template import loader
 from django.forms import modelformset_factory
+from django.db import transaction
 from django.urls import reverse
+from django.views.decorators.http import require_POST
+from django.conf import settings
 
 from .models import Variable, TargetYear, YearlyInputValue
 from .forms import TargetYearForm, YearlyInputValueForm
+from .caching import bump_model_revision
 
+import csv
+import json
 import logging
+import time
 
 logger = logging.getLogger(__name__)
 
+MAX_STREAMED_SIMULATIONS = 10000
+MAX_STREAMED_CHUNK = 1000
+MAX_SCENARIO_SIMULATIONS = 10000
+# Scenarios run in the web worker, so their horizon is bounded like their simulations
+MAX_SCENARIO_TARGET_YEAR = 2200
+MAX_EXPORT_SIMULATIONS = 10000
+EXPORT_FORMATS = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+
+# Engines the graph page offers: Monte Carlo, or the analytic approximation of its mean and std
+GRAPH_ENGINES = ('vectorized', 'analytic')
+
 def manage_target_year(request):
     try:
         target_year = TargetYear.objects.get()
@@ -40,26 +58,39 @@ def input_yearly_values(request):
         return redirect('manage_target_year')
 
     selected_year = request.GET.get('year', target_year)
+    # select_related: every form labels itself with its variable's name
+    queryset = YearlyInputValue.objects.filter(year=selected_year).select_related('variable')
 
     if request.method == 'POST':
-        formset = YearlyInputValueFormSet(request.POST)
+        formset = YearlyInputValueFormSet(request.POST, queryset=queryset)
         if formset.is_valid():
-            instances = formset.save(commit=False)
-            for instance in instances:
-                if instance.value is not None:
-                    instance.save()
-            formset.save_m2m()
+            instances = [instance for instance in formset.save(commit=False) if instance.value is not None]
+            # bulk_update sends no post_save, so the cache revision is bumped here
+            with transaction.atomic():
+                YearlyInputValue.objects.bulk_update(instances, ['value'])
+                transaction.on_commit(bump_model_revision)
             return HttpResponseRedirect(f"{reverse('input_yearly_values')}?year={selected_year}")
         else:
             print("Formset errors:", formset.errors)
             for form in formset:
                 print("Form errors:", form.errors)
     else:
-        for variable in variables:
-            for year in range(2024, target_year + 1):
-                YearlyInputValue.objects.get_or_create(year=year, variable=variable, defaults={'value': None})
+        # Create the missing (variable, year) rows with one query instead of a get_or_create per pair
+        existing = set(
+            YearlyInputValue.objects.filter(variable__in=variables, year__range=(2024, target_year)).values_list('variable_id', 'year')
+        )
+        missing = [
+            YearlyInputValue(variable=variable, year=year, value=None)
+            for variable in variables
+            for year in range(2024, target_year + 1)
+            if (variable.id, year) not in existing
+        ]
+        if missing:
+            with transaction.atomic():
+                YearlyInputValue.objects.bulk_create(missing, ignore_conflicts=True)
+                transaction.on_commit(bump_model_revision)
         
-        formset = YearlyInputValueFormSet(queryset=YearlyInputValue.objects.filter(year=selected_year))
+        formset = YearlyInputValueFormSet(queryset=queryset)
 
     years = list(range(2024, target_year + 1))
     return render(request, 'input_yearly_values.html', {'formset': formset, 'years': years, 'target_year': target_year, 'selected_year': int(selected_year)})
@@ -115,15 +146,34 @@ def output(request):
         if variable.variable_name not in unique_variable_names:
             unique_variable_names.add(variable.variable_name)
             unique_variables.append(variable)
+
+    # The last year's mean and std of every variable, from the precomputed results
+    # (see `manage.py precompute_results`), simulated live only when stale or missing
+    try:
+        target_year = get_target_year()
+        results = stored_simulations([variable.id for variable in unique_variables], target_year)
+    except TargetYear.DoesNotExist:
+        target_year = None
+        results = [None] * len(unique_variables)
+    variables = []
+    for variable, result in zip(unique_variables, results):
+        summary = {'id': variable.id, 'variable_name': variable.variable_name}
+        if result is not None:
+            summary.update({'mean': result[0][-1], 'std': result[1][-1]})
+        variables.append(summary)
+
     template = loader.get_template('output.html')
     context = {
-        'variables': unique_variables,
+        'variables': variables,
+        'target_year': target_year,
     }
     return HttpResponse(template.render(context, request))
 
 # here x1: input value, y1: calculated value, a: multiplier, x0: level in 2023 of x1, y0: level in 2023 of y1
 # def display_graph(x1=3.1, a=5, x0=3, y0=20, sta_dev=1, target=2050):
-from .functions import display_graph
+from .functions import export_series, get_target_year, graph_series, json_series, scenario_series, stored_graph_series, stored_simulations, stream_simulations
+from .jobs import job_queue, JobQueueFull, DONE
+from .sampling import SAMPLING_METHODS
 def graph(request):
    
     unique_name = set()
@@ -141,14 +191,235 @@ def graph(request):
         first_selected_variable_id = unique_calculated_variables[0].id
         second_selected_variable_id = unique_calculated_variables[1].id
     
-    result = display_graph(first_selected_variable_id, second_selected_variable_id)
-    
+    # The graph is read from the precomputed results when they are fresh, otherwise it is
+    # calculated by a background job the page polls for. The analytic engine doesn't
+    # simulate, so there is nothing to refine live.
+    engine = request.GET.get('engine') or 'vectorized'
+    if engine not in GRAPH_ENGINES:
+        return JsonResponse({'error': f'engine must be one of {", ".join(GRAPH_ENGINES)}'}, status=400)
+    sampling = request.GET.get('sampling') or settings.SIMULATION_SAMPLING
+    if sampling not in SAMPLING_METHODS:
+        return JsonResponse({'error': f'sampling must be one of {", ".join(SAMPLING_METHODS)}'}, status=400)
+    stream = request.GET.get('stream') == '1' and engine != 'analytic'
+    series = None
+    if not stream and engine == 'vectorized' and not settings.SIMULATION_TOLERANCE:
+        series = stored_graph_series([first_selected_variable_id, second_selected_variable_id], sampling)
     context = {
-        'graph_html': result, 
         'calculated_variables': unique_calculated_variables, 
         'first_selected_variable_id': int(first_selected_variable_id),
         'second_selected_variable_id': int(second_selected_variable_id),
+        'stream': stream,
+        'series': series,
+        'sampling_methods': SAMPLING_METHODS,
+        'sampling': sampling,
+        'engines': GRAPH_ENGINES,
+        'engine': engine,
     }
     
     return render(request, 'graph.html', context)
 
+# N-variable dashboard: a chart per selected variable (`variables` ids, default: every
+# calculated variable). The page submits them all as one graph job, which simulates the
+# union of their dependencies once and calculates every variable from the same draws.
+def dashboard(request):
+    unique_name = set()
+    unique_calculated_variables = []
+    for variable in Variable.objects.filter(variable_type=Variable.CALCULATED):
+        if variable.variable_name not in unique_name:
+            unique_name.add(variable.variable_name)
+            unique_calculated_variables.append(variable)
+
+    try:
+        selected_variable_ids = [int(variable_id) for variable_id in request.GET.getlist('variables')]
+    except ValueError:
+        return JsonResponse({'error': 'variables must be variable ids'}, status=400)
+    sampling = request.GET.get('sampling') or settings.SIMULATION_SAMPLING
+    if sampling not in SAMPLING_METHODS:
+        return JsonResponse({'error': f'sampling must be one of {", ".join(SAMPLING_METHODS)}'}, status=400)
+    engine = request.GET.get('engine') or 'vectorized'
+    if engine not in GRAPH_ENGINES:
+        return JsonResponse({'error': f'engine must be one of {", ".join(GRAPH_ENGINES)}'}, status=400)
+
+    context = {
+        'selected_variable_ids': selected_variable_ids or [variable.id for variable in unique_calculated_variables],
+        'sampling': sampling,
+        'engine': engine,
+    }
+    return render(request, 'dashboard.html', context)
+
+# Starts calculating the series of the posted `variables` ids, returns the job to poll.
+# An optional `tolerance` runs adaptive simulations instead of a fixed number,
+# an optional `sampling` picks how the noise is drawn (see variables/sampling.py)
+# and engine=analytic approximates the series without simulating.
+@require_POST
+def submit_graph_job(request):
+    try:
+        selected_variable_ids = [int(variable_id) for variable_id in request.POST.getlist('variables')]
+        tolerance = float(request.POST.get('tolerance', 0))
+    except ValueError:
+        return JsonResponse({'error': 'variables must be variable ids and tolerance a number'}, status=400)
+    if not selected_variable_ids:
+        return JsonResponse({'error': 'variables is required'}, status=400)
+    sampling = request.POST.get('sampling') or settings.SIMULATION_SAMPLING
+    if sampling not in SAMPLING_METHODS:
+        return JsonResponse({'error': f'sampling must be one of {", ".join(SAMPLING_METHODS)}'}, status=400)
+    engine = request.POST.get('engine') or 'vectorized'
+    if engine not in GRAPH_ENGINES:
+        return JsonResponse({'error': f'engine must be one of {", ".join(GRAPH_ENGINES)}'}, status=400)
+
+    try:
+        job_id = job_queue.submit(graph_series, selected_variable_ids, tolerance, sampling, engine)
+    except JobQueueFull:
+        return JsonResponse({'error': 'Too many graphs are being calculated, please retry shortly'}, status=503)
+
+    return JsonResponse({'job_id': job_id, 'status_url': reverse('graph_job_status', args=[job_id])}, status=202)
+
+# Server-Sent Events: the running mean and std after every chunk of simulations,
+# then a `done` event. The client closes the stream once the bands look stable.
+# The stream holds a sync worker, so it also ends after SIMULATION_STREAM_SECONDS,
+# with a `done` event whose timed_out is true.
+def stream_graph(request):
+    try:
+        selected_variable_ids = [int(variable_id) for variable_id in request.GET.getlist('variables')]
+        num_simulations = min(int(request.GET.get('simulations', 100)), MAX_STREAMED_SIMULATIONS)
+        chunk_size = min(max(int(request.GET.get('chunk', 10)), 1), MAX_STREAMED_CHUNK)
+    except ValueError:
+        return JsonResponse({'error': 'variables, simulations and chunk must be integers'}, status=400)
+    if not selected_variable_ids:
+        return JsonResponse({'error': 'variables is required'}, status=400)
+    sampling = request.GET.get('sampling') or settings.SIMULATION_SAMPLING
+    if sampling not in SAMPLING_METHODS:
+        return JsonResponse({'error': f'sampling must be one of {", ".join(SAMPLING_METHODS)}'}, status=400)
+
+    def events():
+        deadline = time.monotonic() + settings.SIMULATION_STREAM_SECONDS
+        for update in stream_simulations(selected_variable_ids, num_simulations, chunk_size, sampling=sampling):
+            if 'error' in update:
+                yield f'event: error\ndata: {json.dumps(update)}\n\n'
+                return
+            yield f'data: {json.dumps(update)}\n\n'
+            if time.monotonic() > deadline and update['simulations'] < num_simulations:
+                yield f'event: done\ndata: {json.dumps({"timed_out": True})}\n\n'
+                return
+        yield 'event: done\ndata: {}\n\n'
+
+    response = StreamingHttpResponse(events(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+def graph_job_status(request, job_id):
+    job = job_queue.status(job_id)
+    if job is None:
+        return JsonResponse({'error': 'Unknown job'}, status=404)
+
+    response = {'job_id': job_id, 'status': job['status']}
+    if job['status'] == DONE:
+        response['result'] = job['result']
+    elif 'error' in job:
+        response['error'] = job['error']
+    return JsonResponse(response)
+
+# csv.writer target that hands every formatted row back instead of buffering it
+class Echo:
+    def write(self, value):
+        return value
+
+# Per-year mean, std and P5/P50/P95 of the `variables` ids (default: every calculated
+# variable) as CSV or NDJSON (`format`), one row per variable and year. The response is
+# streamed and flushed variable by variable as they are read from the precomputed results
+# or simulated live, in batches of at most 50 variables (see export_series), so exporting
+# the whole model holds one batch in memory at a time and the first variable arrives at once.
+# Variables that can't be calculated are left out of the CSV and get an error line in NDJSON.
+def export(request):
+    export_format = request.GET.get('format', 'csv')
+    if export_format not in EXPORT_FORMATS:
+        return JsonResponse({'error': f'format must be one of {", ".join(EXPORT_FORMATS)}'}, status=400)
+    try:
+        selected_variable_ids = [int(variable_id) for variable_id in request.GET.getlist('variables')]
+        num_simulations = min(int(request.GET.get('simulations', 100)), MAX_EXPORT_SIMULATIONS)
+    except ValueError:
+        return JsonResponse({'error': 'variables and simulations must be integers'}, status=400)
+    sampling = request.GET.get('sampling') or settings.SIMULATION_SAMPLING
+    if sampling not in SAMPLING_METHODS:
+        return JsonResponse({'error': f'sampling must be one of {", ".join(SAMPLING_METHODS)}'}, status=400)
+    try:
+        target_year = get_target_year()
+    except TargetYear.DoesNotExist:
+        return JsonResponse({'error': "Target year doesn't exist"}, status=400)
+
+    if selected_variable_ids:
+        found = set(Variable.objects.filter(id__in=selected_variable_ids).values_list('id', flat=True))
+        if len(found) != len(set(selected_variable_ids)):
+            return JsonResponse({'error': "Variable doesn't exist"}, status=400)
+    else:
+        unique_name = set()
+        for variable in Variable.objects.filter(variable_type=Variable.CALCULATED):
+            if variable.variable_name not in unique_name:
+                unique_name.add(variable.variable_name)
+                selected_variable_ids.append(variable.id)
+
+    years = list(range(2023, target_year + 1))
+    columns = ('mean', 'std', 'p5', 'p50', 'p95')
+
+    def rows():
+        writer = csv.writer(Echo())
+        if export_format == 'csv':
+            yield writer.writerow(('variable_id', 'variable', 'year') + columns)
+        for variable, result in export_series(selected_variable_ids, target_year, max(num_simulations, 1), sampling):
+            if result is None:
+                logger.error(f'{variable.variable_name} could not be calculated')
+                if export_format == 'ndjson':
+                    yield json.dumps({'variable_id': variable.id, 'variable': variable.variable_name, 'error': 'could not be calculated'}) + '\n'
+                continue
+            mean_values, std_dev_values, _, bands = result
+            values = list(zip(*(json_series(series) for series in (mean_values, std_dev_values, bands[5], bands[50], bands[95]))))
+            # One chunk per variable, so it is flushed as soon as it is calculated
+            if export_format == 'csv':
+                yield ''.join(writer.writerow((variable.id, variable.variable_name, year) + row) for year, row in zip(years, values))
+            else:
+                yield ''.join(
+                    json.dumps({'variable_id': variable.id, 'variable': variable.variable_name, 'year': year, **dict(zip(columns, row))}) + '\n'
+                    for year, row in zip(years, values)
+                )
+
+    response = StreamingHttpResponse(rows(), content_type=EXPORT_FORMATS[export_format])
+    response['Content-Disposition'] = f'attachment; filename="world_model_{target_year}.{export_format}"'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+# What-if scenario evaluated in memory, nothing is written to the database. JSON body:
+#   {"variables": [ids], "inputs": {"<input id>": {"<year>": value or null}},
+#    "coefficients": {"<variable id>": {"<field>": value or null}},
+#    "target_year": null, "simulations": 100, "seed": null, "sampling": "random"}
+# Returns the series of every variable; those the scenario changes also get their baseline
+# and the distribution of the paired difference scenario - baseline.
+@require_POST
+def scenario(request):
+    try:
+        body = json.loads(request.body)
+        selected_variable_ids = [int(variable_id) for variable_id in body.get('variables', [])]
+        inputs = {int(variable_id): points for variable_id, points in body.get('inputs', {}).items()}
+        coefficients = {int(variable_id): fields for variable_id, fields in body.get('coefficients', {}).items()}
+        num_simulations = min(int(body.get('simulations', 100)), MAX_SCENARIO_SIMULATIONS)
+        seed = body.get('seed')
+        seed = None if seed is None else int(seed)
+        target_year = body.get('target_year')
+        target_year = None if target_year is None else int(target_year)
+    except (ValueError, TypeError, AttributeError):
+        return JsonResponse({'error': 'The body must be a JSON scenario with integer variable ids'}, status=400)
+    if not selected_variable_ids:
+        return JsonResponse({'error': 'variables is required'}, status=400)
+    if target_year is not None and target_year > MAX_SCENARIO_TARGET_YEAR:
+        return JsonResponse({'error': f'target_year must be at most {MAX_SCENARIO_TARGET_YEAR}'}, status=400)
+    sampling = body.get('sampling') or settings.SIMULATION_SAMPLING
+    if sampling not in SAMPLING_METHODS:
+        return JsonResponse({'error': f'sampling must be one of {", ".join(SAMPLING_METHODS)}'}, status=400)
+
+    try:
+        series = scenario_series(selected_variable_ids, inputs, coefficients, max(num_simulations, 1), seed, sampling, target_year)
+    except (ValueError, TypeError) as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    if series is None:
+        return JsonResponse({'error': 'The scenario could not be calculated'}, status=400)
+    return JsonResponse(series)
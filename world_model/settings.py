@@ -47,6 +47,7 @@ X_FRAME_OPTIONS = "SAMEORIGIN"
 SILENCED_SYSTEM_CHECKS = ["security.W019"]
 
 MIDDLEWARE = [
+    'variables.instrumentation.ServerTimingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -93,6 +94,82 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/5.0/topics/cache/
+# Shared by all gunicorn workers; the database backend needs `python manage.py createcachetable`.
+
+CACHES = {
+    'default': {
+        'BACKEND': config('CACHE_BACKEND', default='django.core.cache.backends.db.DatabaseCache'),
+        'LOCATION': config('CACHE_LOCATION', default='world_model_cache'),
+    },
+    # Simulation results, see variables.caching.ResultCache
+    'results': {
+        'BACKEND': config('RESULT_CACHE_BACKEND', default='django.core.cache.backends.db.DatabaseCache'),
+        'LOCATION': config('RESULT_CACHE_LOCATION', default='world_model_results'),
+        'OPTIONS': {
+            'MAX_ENTRIES': config('RESULT_CACHE_MAX_ENTRIES', default=2000, cast=int),
+        },
+    },
+}
+
+
+# Simulations, see variables/jobs.py and variables/parallel.py
+
+SIMULATION_JOB_WORKERS = config('SIMULATION_JOB_WORKERS', default=2, cast=int)
+SIMULATION_JOB_QUEUE_SIZE = config('SIMULATION_JOB_QUEUE_SIZE', default=8, cast=int)
+SIMULATION_JOB_TIMEOUT = config('SIMULATION_JOB_TIMEOUT', default=120, cast=int)
+
+# Processes each simulation is split across, 1 runs it in the web worker itself
+SIMULATION_PROCESSES = config('SIMULATION_PROCESSES', default=1, cast=int)
+
+# Simulations evaluated at once; the statistics are streamed chunk by chunk, so this
+# bounds the engine's memory whatever the number of simulations
+SIMULATION_CHUNK_SIZE = config('SIMULATION_CHUNK_SIZE', default=1024, cast=int)
+
+# Relative standard error the graph's adaptive simulations stop at (0 runs a fixed 100),
+# and the most simulations they may use
+SIMULATION_TOLERANCE = config('SIMULATION_TOLERANCE', default=0, cast=float)
+SIMULATION_MAX_SIMULATIONS = config('SIMULATION_MAX_SIMULATIONS', default=10000, cast=int)
+
+# How the noise is drawn: random, antithetic, lhs (Latin hypercube) or sobol, see variables/sampling.py
+SIMULATION_SAMPLING = config('SIMULATION_SAMPLING', default='random')
+
+# Seconds a streamed graph (variables.views.stream_graph) may simulate for. The stream holds
+# a sync gunicorn worker, which is killed after its --timeout (30 s by default), so this
+# must stay below it.
+SIMULATION_STREAM_SECONDS = config('SIMULATION_STREAM_SECONDS', default=20, cast=float)
+
+
+# Per-request timings, see variables/instrumentation.py. Requests slower than the
+# threshold (milliseconds, 0 disables profiling) are dumped as cProfile stats.
+
+SERVER_TIMING_PROFILE_THRESHOLD = config('SERVER_TIMING_PROFILE_THRESHOLD', default=0, cast=float)
+SERVER_TIMING_PROFILE_DIR = BASE_DIR / 'profiles'
+
+
+# Logging
+# https://docs.djangoproject.com/en/5.0/topics/logging/
+# The variables app logs one JSON line of timings per request and per simulation job at INFO.
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'variables': {
+            'handlers': ['console'],
+            'level': config('VARIABLES_LOG_LEVEL', default='INFO'),
+            'propagate': False,
+        },
+    },
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
 